@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+"""
+Generate a synthetic input_dir for benchmarks.
+
+Nodes are split into chain_depth layers, and each node depends on fan_in random nodes
+of the previous layer, so the longest dependency chain has chain_depth nodes.
+Each SCC injected makes a node and one of its dependencies depend on each other.
+UCIs are spread over a hierarchy of sections which is depth levels deep.
+"""
+
+import argparse
+import json
+import os
+from os.path import join as pjoin
+import random
+import shutil
+from collections import OrderedDict
+
+WORDS = ('set', 'group', 'ring', 'field', 'limit', 'proof', 'theorem', 'lemma', 'vector',
+    'space', 'graph', 'order', 'map', 'prime', 'matrix', 'series', 'integral', 'measure')
+TEX_SNIPPETS = ('$x_{}^2$', '$\\sum_{{i=1}}^{} a_i$', '$\\frac{{a}}{{b_{}}}$', '$f(x_{})$')
+
+
+def get_uci(i, depth, branching):
+    parts = []
+    x = i
+    for level in range(depth):
+        parts.append('s{}'.format(x % branching))
+        x //= branching
+    return '/' + '/'.join(parts + ['n{}'.format(i)])
+
+
+def make_text(rng, size, tex_density):
+    # about size characters of markdown, where a tex_density fraction of words is TeX
+    words = []
+    length = 0
+    while length < size:
+        if rng.random() < tex_density:
+            word = rng.choice(TEX_SNIPPETS).format(rng.randrange(10))
+        else:
+            word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)
+
+
+def get_layers(n, chain_depth):
+    chain_depth = max(1, min(chain_depth, n))
+    return [list(range(n * k // chain_depth, n * (k + 1) // chain_depth))
+        for k in range(chain_depth)]
+
+
+def make_deps(rng, n, fan_in, chain_depth, sccs):
+    deps = [[] for i in range(n)]
+    layers = get_layers(n, chain_depth)
+    for prev_layer, layer in zip(layers, layers[1:]):
+        for i in layer:
+            deps[i] = rng.sample(prev_layer, min(fan_in, len(prev_layer)))
+    candidates = [i for i in range(n) if deps[i]]
+    for i in rng.sample(candidates, min(sccs, len(candidates))):
+        j = rng.choice(deps[i])
+        if i not in deps[j]:
+            deps[j].append(i)
+    return deps
+
+
+def generate(input_dir, n, depth=2, branching=10, fan_in=3, chain_depth=20, sccs=0,
+        inline_size=200, include_size=0, include_fraction=0.0, tex_density=0.1, seed=0):
+    rng = random.Random(seed)
+    if os.path.exists(input_dir):
+        shutil.rmtree(input_dir)
+    ucis = [get_uci(i, depth, branching) for i in range(n)]
+    deps = make_deps(rng, n, fan_in, chain_depth, sccs)
+
+    for i, uci in enumerate(ucis):
+        document = []
+        if inline_size:
+            document.append(OrderedDict([('type', 'inline'),
+                ('text', make_text(rng, inline_size, tex_density))]))
+        if include_size and rng.random() < include_fraction:
+            include_relpath = uci + '.md'
+            include_fpath = pjoin(input_dir, 'includes', *include_relpath[1:].split('/'))
+            os.makedirs(os.path.dirname(include_fpath), exist_ok=True)
+            with open(include_fpath, 'w') as fp:
+                fp.write(make_text(rng, include_size, tex_density))
+            document.append(OrderedDict([('type', 'include'), ('path', include_relpath)]))
+        d = OrderedDict([
+            ('deps', [ucis[j] for j in deps[i]]),
+            ('metadata', OrderedDict([
+                ('title', 'Node {} {}'.format(i, rng.choice(WORDS))),
+                ('description', make_text(rng, 40, 0)),
+            ])),
+            ('document', document),
+        ])
+        fpath = pjoin(input_dir, 'nodes', *(uci[1:] + '.json').split('/'))
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, 'w') as fp:
+            json.dump(d, fp)
+
+    config = OrderedDict([('NAME', 'Benchmark'), ('SEARCH_FIELDS', ['title', 'description']),
+        ('DISABLE', ['dot'])])
+    with open(pjoin(input_dir, 'config.json'), 'w') as fp:
+        json.dump(config, fp, indent=4)
+    return ucis
+
+
+def add_generator_args(parser):
+    parser.add_argument('-n', '--nodes', type=int, default=1000)
+    parser.add_argument('--depth', type=int, default=2,
+        help='Number of levels of sections in UCIs')
+    parser.add_argument('--branching', type=int, default=10,
+        help='Number of sections in each section')
+    parser.add_argument('--fan-in', type=int, default=3,
+        help='Number of dependencies of each node')
+    parser.add_argument('--chain-depth', type=int, default=20,
+        help='Number of nodes in the longest dependency chain')
+    parser.add_argument('--sccs', type=int, default=0,
+        help='Number of cycles to inject')
+    parser.add_argument('--inline-size', type=int, default=200,
+        help='Size in characters of the inline document of each node')
+    parser.add_argument('--include-size', type=int, default=0,
+        help='Size in characters of included documents')
+    parser.add_argument('--include-fraction', type=float, default=0.0,
+        help='Fraction of nodes which include a document')
+    parser.add_argument('--tex-density', type=float, default=0.1,
+        help='Fraction of words in documents which are TeX')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def get_generator_kwargs(args):
+    return OrderedDict([('n', args.nodes), ('depth', args.depth), ('branching', args.branching),
+        ('fan_in', args.fan_in), ('chain_depth', args.chain_depth), ('sccs', args.sccs),
+        ('inline_size', args.inline_size), ('include_size', args.include_size),
+        ('include_fraction', args.include_fraction), ('tex_density', args.tex_density),
+        ('seed', args.seed)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('input_dir',
+        help='Directory to write the corpus to (replaced if it exists)')
+    add_generator_args(parser)
+    args = parser.parse_args()
+    generate(args.input_dir, **get_generator_kwargs(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+Stress-test lib.graph on large synthetic graphs.
+
+Each case runs in a fresh process, so that its peak memory usage can be
+measured and a case which runs out of memory doesn't stop the others.
+"""
+
+import argparse
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from lib.graph import Graph
+
+SHAPES = ('chain', 'wide')
+
+
+def make_graph(shape, n, fan_in=3, seed=0):
+    graph = Graph()
+    for i in range(n):
+        graph.add_vertex(i)
+    if shape == 'chain':
+        for i in range(1, n):
+            graph.add_edge(i - 1, i)
+    elif shape == 'wide':
+        # layers of about sqrt(n) vertices, each depending on vertices of the previous layer
+        rng = random.Random(seed)
+        width = max(1, int(n ** 0.5))
+        for i in range(width, n):
+            layer_start = (i // width - 1) * width
+            for j in rng.sample(range(layer_start, layer_start + width), min(fan_in, width)):
+                graph.add_edge(j, i)
+    else:
+        raise ValueError('unknown shape ' + repr(shape))
+    return graph
+
+
+def get_maxrss_mb():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+
+
+def run_case(shape, n, fan_in, closure):
+    result = {'shape': shape, 'n': n}
+    start_time = time.perf_counter()
+    graph = make_graph(shape, n, fan_in)
+    graph.freeze()
+    result['build'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    graph.scc()
+    result['scc'] = time.perf_counter() - start_time
+
+    if closure:
+        start_time = time.perf_counter()
+        graph.transitive_closure()
+        result['closure'] = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        for u in graph.get_labels():
+            graph.get_degrees(u)
+        result['degrees'] = time.perf_counter() - start_time
+    result['maxrss_mb'] = get_maxrss_mb()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--shapes', nargs='+', choices=SHAPES, default=SHAPES)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10**5, 3 * 10**5, 10**6])
+    parser.add_argument('--fan-in', type=int, default=3)
+    parser.add_argument('--max-closure-size', type=int, default=10**5,
+        help='Skip transitive closure for graphs with more vertices than this')
+    args = parser.parse_args()
+
+    fields = ('build', 'scc', 'closure', 'degrees')
+    print('{:>6} {:>8} '.format('shape', 'n') + ' '.join(['{:>9}'.format(f) for f in fields])
+        + ' {:>10}'.format('maxrss_mb'))
+    for shape in args.shapes:
+        for n in args.sizes:
+            closure = n <= args.max_closure_size
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                try:
+                    result = executor.submit(run_case, shape, n, args.fan_in, closure).result()
+                except Exception as e:
+                    print('{:>6} {:>8} failed: {!r}'.format(shape, n, e))
+                    continue
+            times = ['{:>9.3f}'.format(result[f]) if f in result else '{:>9}'.format('-')
+                for f in fields]
+            print('{:>6} {:>8} '.format(shape, n) + ' '.join(times)
+                + ' {:>10.1f}'.format(result['maxrss_mb']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the pipeline on a synthetic corpus (see bench.corpus).
+
+The cases are a full build, a no-op rebuild and a rebuild after editing one node.
+The time taken by each stage of each case is measured, and so is the time taken by
+Graph.scc and Graph.transitive_closure on the corpus's graph.
+Every time is the minimum over --repeat runs.
+Results can be written to a JSON file and compared with those of an earlier run.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+from os.path import join as pjoin
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import main as concepdag
+from lib import common, process, store
+from bench.corpus import add_generator_args, get_generator_kwargs, generate
+from bench.graph_stress import get_maxrss_mb
+
+CASES = ('full', 'noop', 'edit')
+
+
+def edit_node(input_dir, uci):
+    fpath = pjoin(input_dir, 'nodes', *(uci[1:] + '.json').split('/'))
+    d = common.read_json_obj(fpath)
+    d['metadata']['description'] += ' edited'
+    common.write_json_obj(d, fpath)
+
+
+def run_build(build_args, store_kind, timings):
+    records = store.open_store(store_kind, build_args.intermediate_dir, False)
+    try:
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            concepdag.build(build_args, records, timings=timings)
+        timings['total'] = time.perf_counter() - start_time
+    finally:
+        records.close()
+
+
+def time_graph(build_args, store_kind):
+    timings = OrderedDict()
+    records = store.open_store(store_kind, build_args.intermediate_dir, False)
+    try:
+        start_time = time.perf_counter()
+        data, graph, broken_deps = process.build_graph(records)
+        timings['build'] = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        graph.scc()
+        timings['scc'] = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        graph.transitive_closure()
+        timings['closure'] = time.perf_counter() - start_time
+    finally:
+        records.close()
+    return timings
+
+
+def run_once(input_dir, work_dir, edit_uci, jobs, store_kind):
+    """Run every case once on a copy of input_dir. Returns a dict of times in seconds."""
+    case_input_dir = pjoin(work_dir, 'input')
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    shutil.copytree(input_dir, case_input_dir)
+    build_args = concepdag.get_arg_parser().parse_args([case_input_dir,
+        pjoin(work_dir, 'intermediate'), pjoin(work_dir, 'output'), '--jobs', str(jobs),
+        '--store', store_kind])
+
+    results = OrderedDict()
+    for case in CASES:
+        if case == 'edit':
+            edit_node(case_input_dir, edit_uci)
+        timings = OrderedDict()
+        run_build(build_args, store_kind, timings)
+        for stage, seconds in timings.items():
+            results[case + '.' + stage] = seconds
+    for name, seconds in time_graph(build_args, store_kind).items():
+        results['graph.' + name] = seconds
+    return results
+
+
+def compare(results, baseline, threshold, min_delta):
+    """Print results next to baseline. Returns the names of the times which regressed."""
+    regressions = []
+    print('{:<20} {:>10} {:>10} {:>8}'.format('name', 'baseline', 'current', 'change'))
+    for name, seconds in results.items():
+        old_seconds = baseline.get(name)
+        if old_seconds is None:
+            print('{:<20} {:>10} {:>10.4f}'.format(name, '-', seconds))
+            continue
+        change = (seconds - old_seconds) / old_seconds if old_seconds else 0
+        regressed = seconds > old_seconds * (1 + threshold) and seconds - old_seconds > min_delta
+        if regressed:
+            regressions.append(name)
+        print('{:<20} {:>10.4f} {:>10.4f} {:>+7.1%}{}'.format(name, old_seconds, seconds,
+            change, ' REGRESSED' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_generator_args(parser)
+    parser.add_argument('--input-dir',
+        help='Benchmark this input_dir instead of generating a corpus')
+    parser.add_argument('--work-dir',
+        help='Directory for the corpus and build outputs (default: a temporary directory)')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--store', choices=['dir', 'sqlite'], default='dir')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help='Write results to this JSON file')
+    parser.add_argument('--baseline', help='Compare with results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help='Relative slowdown above which a time counts as a regression')
+    parser.add_argument('--min-delta', type=float, default=0.01,
+        help='Slowdowns of fewer seconds than this are never regressions')
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        work_dir = args.work_dir or stack.enter_context(tempfile.TemporaryDirectory())
+        if args.input_dir is not None:
+            input_dir = args.input_dir
+            params = OrderedDict([('input_dir', os.path.abspath(input_dir))])
+        else:
+            input_dir = pjoin(work_dir, 'corpus')
+            params = get_generator_kwargs(args)
+            generate(input_dir, **params)
+        ucis = [uci for uci, fpath in common.get_uci_fpath_list(pjoin(input_dir, 'nodes'))]
+        edit_uci = sorted(ucis)[len(ucis) // 2]
+        params['jobs'] = args.jobs
+        params['store'] = args.store
+
+        results = OrderedDict()
+        for i in range(args.repeat):
+            for name, seconds in run_once(input_dir, pjoin(work_dir, 'run'), edit_uci,
+                    args.jobs, args.store).items():
+                results[name] = min(seconds, results.get(name, seconds))
+
+    output = OrderedDict([
+        ('params', params),
+        ('python', platform.python_version()),
+        ('maxrss_mb', get_maxrss_mb()),
+        ('results', results),
+    ])
+    if args.output is not None:
+        common.write_json_obj(output, args.output, indent=4)
+
+    if args.baseline is not None:
+        baseline = common.read_json_obj(args.baseline)
+        if baseline['params'] != params:
+            print('warning: baseline was run with different parameters', file=sys.stderr)
+        regressions = compare(results, baseline['results'], args.threshold, args.min_delta)
+        if regressions:
+            print('{} times regressed: {}'.format(len(regressions), ', '.join(regressions)),
+                file=sys.stderr)
+            sys.exit(1)
+    else:
+        for name, seconds in results.items():
+            print('{:<20} {:>10.4f}'.format(name, seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+DiskCache is a size-bounded on-disk key-value cache, shared across processes and runs.
+
+Each entry is stored in its own file, so concurrent workers can read and
+write entries without locking. Reading an entry bumps its mtime, and evict()
+deletes the least recently used entries once the cache is over its size bound.
+
+MemoryCache is a size-bounded in-memory LRU cache.
+"""
+
+import os
+from os.path import join as pjoin
+from collections import OrderedDict
+
+
+class DiskCache:
+
+    def __init__(self, cache_dir, max_size):
+        # max_size is in bytes
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def get_fpath(self, key):
+        return pjoin(self.cache_dir, key[:2], key[2:])
+
+    def get(self, key):
+        fpath = self.get_fpath(key)
+        try:
+            with open(fpath) as fp:
+                value = fp.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(fpath)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key, value):
+        fpath = self.get_fpath(key)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        temp_fpath = '{}.{}.tmp'.format(fpath, os.getpid())
+        with open(temp_fpath, 'w') as fp:
+            fp.write(value)
+        os.replace(temp_fpath, fpath)
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        for dirpath, dirnames, fnames in os.walk(self.cache_dir):
+            for fname in fnames:
+                fpath = pjoin(dirpath, fname)
+                stat = os.stat(fpath)
+                entries.append((stat.st_mtime, fpath, stat.st_size))
+                total_size += stat.st_size
+        entries.sort()
+        for mtime, fpath, size in entries:
+            if total_size <= self.max_size:
+                break
+            os.remove(fpath)
+            total_size -= size
+
+
+class MemoryCache:
+    """An in-memory LRU cache of strings, bounded by their total length."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.pop(key)
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.max_size and self.entries:
+            key2, value2 = self.entries.popitem(last=False)
+            self.size -= len(value2)
+
+    def pop(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.size -= len(value)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
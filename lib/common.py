@@ -1,20 +1,23 @@
 import os
 from os.path import join as pjoin
-import time
 import json
-from collections import OrderedDict
+import hashlib
+import shutil
+from collections import OrderedDict, deque
+
+from . import profile
 
 
 DEFAULT_SITE_NAME = 'ConcepDAG'
 debug = False
 
 
-def get_uci_fpath_list(nodes_dir):
+def get_uci_fpath_list(nodes_dir, ext='.json'):
     uci_fpath_list = []
     for dirpath, dirnames, fnames in os.walk(nodes_dir):
         for fname in fnames:
-            base, ext = os.path.splitext(fname)
-            if ext == '.json':
+            base, ext2 = os.path.splitext(fname)
+            if ext2 == ext:
                 fpath = pjoin(dirpath, fname)
                 uci = '/' + os.path.relpath(pjoin(dirpath, base), nodes_dir)
                 if os.path.sep != '/':
@@ -26,42 +29,270 @@ def get_uci_fpath_list(nodes_dir):
 def read_json_obj(fpath):
     try:
         with open(fpath) as fobj:
-            return json.load(fobj, object_pairs_hook=OrderedDict)
+            s = fobj.read()
+        profile.count('files_read')
+        profile.count('bytes_read', len(s))
+        return json.loads(s, object_pairs_hook=OrderedDict)
     except json.JSONDecodeError as e:
         raise Exception('could not read json file: ' + fpath) from e
 
 
 def write_json_obj(obj, fpath, indent=None):
-    dirpath = os.path.dirname(fpath)
-    os.makedirs(dirpath, exist_ok=True)
-    with open(fpath, 'w') as fobj:
-        json.dump(obj, fobj, indent=indent)
+    return write_string_to_file(json.dumps(obj, indent=indent), fpath)
 
 
 def write_string_to_file(s, fpath):
+    """
+    Write s to fpath, unless fpath already contains s.
+    Returns whether fpath was written.
+    """
+    try:
+        with open(fpath) as fp:
+            if fp.read() == s:
+                profile.count('writes_skipped')
+                return False
+    except (FileNotFoundError, UnicodeDecodeError):
+        pass
     dirpath = os.path.dirname(fpath)
-    os.makedirs(dirpath, exist_ok=True)
+    if dirpath:
+        os.makedirs(dirpath, exist_ok=True)
     with open(fpath, 'w') as fp:
         fp.write(s)
+    profile.count('files_written')
+    profile.count('bytes_written', len(s))
+    return True
 
 
-def read_timestamp(intermediate_dir):
+def remove_file(fpath, root_dir):
+    """Remove fpath and then its ancestors below root_dir which become empty."""
     try:
-        fpath = pjoin(intermediate_dir, 'last_run_ns.txt')
-        with open(fpath) as fp:
-            result = int(fp.read())
         os.remove(fpath)
-        return result
     except FileNotFoundError:
-        return None
+        return
+    dirpath = os.path.dirname(fpath)
+    root_dir = os.path.abspath(root_dir)
+    while os.path.abspath(dirpath) != root_dir:
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            break
+        dirpath = os.path.dirname(dirpath)
+
+
+def get_node_relpath(uci):
+    # path of a node's page relative to output_dir
+    return 'nodes' + uci + '.html'
+
+
+def get_node_fragment_relpath(uci):
+    # path of the JSON file with the parts of a node's dependency lists left out of its page
+    return 'nodes' + uci + '.deps.json'
+
+
+def is_safe_uci(uci):
+    # whether uci is made of path segments which can't lead out of a store's directory,
+    # like those of UCIs which come from input file paths
+    parts = uci.split('/')
+    return len(parts) > 1 and parts[0] == '' and all(part not in ('', '.', '..')
+        and '\\' not in part for part in parts[1:])
+
+
+def get_uci_from_node_relpath(relpath):
+    # inverse of get_node_relpath; returns None if relpath isn't a node's page
+    if relpath.startswith('nodes/') and relpath.endswith('.html'):
+        uci = relpath[len('nodes'): -len('.html')]
+        return uci if is_safe_uci(uci) else None
+    return None
+
+
+def get_uci_from_node_fragment_relpath(relpath):
+    if relpath.startswith('nodes/') and relpath.endswith('.deps.json'):
+        uci = relpath[len('nodes'): -len('.deps.json')]
+        return uci if is_safe_uci(uci) else None
+    return None
+
+
+def batched(iterable, n):
+    batch = []
+    for x in iterable:
+        batch.append(x)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def imap_bounded(executor, func, iterable, max_in_flight):
+    """
+    Like executor.map, but consumes iterable lazily and
+    keeps at most max_in_flight tasks submitted at a time.
+    Results are yielded in order.
+    """
+    futures = deque()
+    for x in iterable:
+        if len(futures) >= max_in_flight:
+            yield futures.popleft().result()
+        futures.append(executor.submit(func, x))
+    while futures:
+        yield futures.popleft().result()
+
+
+def hash_string(s):
+    return hashlib.sha256(s.encode()).hexdigest()
+
+
+def hash_file(fpath):
+    with open(fpath, 'rb') as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
 
 
-def write_timestamp(intermediate_dir, timestamp):
-    with open(pjoin(intermediate_dir, 'last_run_ns.txt'), 'w') as fp:
-        fp.write(str(timestamp))
+def hash_dir(dirpath):
+    h = hashlib.sha256()
+    for dirpath2, dirnames, fnames in sorted(os.walk(dirpath)):
+        for fname in sorted(fnames):
+            fpath = pjoin(dirpath2, fname)
+            h.update(os.path.relpath(fpath, dirpath).encode())
+            h.update(hash_file(fpath).encode())
+    return h.hexdigest()
 
 
-def get_config(input_dir, intermediate_dir):
+def get_relpath(fpath, base_dir):
+    relpath = os.path.relpath(fpath, base_dir)
+    if os.path.sep != '/':
+        relpath = relpath.replace(os.path.sep, '/')
+    return relpath
+
+
+class BuildManifest:
+    """
+    Content hashes of the inputs of the last successful build,
+    stored as the 'manifest' meta record of the intermediate store.
+    Files are keyed by their path relative to input_dir.
+    It also records a hash of the graph-dependent parts of each node's render context.
+    If changed_paths (a set of absolute paths) is given, files outside it are assumed
+    to be unchanged since the last build, so their old hashes are reused.
+    """
+
+    def __init__(self, store, changed_paths=None):
+        obj = store.get('meta', 'manifest') or {}
+        self.old_hashes = obj.get('hashes', {})
+        self.old_node_includes = obj.get('node_includes', {})
+        self.old_context_hashes = obj.get('context_hashes', {})
+        self.hashes = {}
+        self.node_includes = {}
+        self.context_hashes = self.old_context_hashes
+        self.changed_paths = changed_paths
+
+    def hash_file(self, key, fpath):
+        digest = self.hashes.get(key)
+        if digest is None:
+            if (self.changed_paths is not None and key in self.old_hashes
+                    and os.path.abspath(fpath) not in self.changed_paths):
+                digest = self.old_hashes[key]
+            else:
+                digest = hash_file(fpath)
+            self.hashes[key] = digest
+        return digest
+
+    def is_modified(self, key, digest):
+        self.hashes[key] = digest
+        return self.old_hashes.get(key) != digest
+
+    def keep(self, key):
+        # carry key's hash over from the last build, for inputs which weren't looked at
+        if key in self.old_hashes:
+            self.hashes.setdefault(key, self.old_hashes[key])
+
+    def save(self, store):
+        obj = OrderedDict([
+            ('hashes', OrderedDict(sorted(self.hashes.items()))),
+            ('node_includes', OrderedDict(sorted(self.node_includes.items()))),
+            ('context_hashes', OrderedDict(sorted(self.context_hashes.items()))),
+        ])
+        store.put('meta', 'manifest', obj)
+
+
+class OutputTracker:
+    """
+    Writes files to output_dir, skipping files whose content is unchanged,
+    and keeps track of the hash of every output file.
+    Hashes are stored as the 'outputs' meta record of the intermediate store.
+    Output files are keyed by their path relative to output_dir.
+    """
+
+    def __init__(self, output_dir, store):
+        self.output_dir = output_dir
+        self.old_hashes = store.get('meta', 'outputs') or {}
+        self.hashes = dict(self.old_hashes)
+
+    def get_fpath(self, relpath):
+        return pjoin(self.output_dir, *relpath.split('/'))
+
+    def record(self, relpath, digest):
+        self.hashes[relpath] = digest
+
+    def write_string(self, relpath, s):
+        write_string_to_file(s, self.get_fpath(relpath))
+        self.record(relpath, hash_string(s))
+
+    def write_json(self, relpath, obj, indent=None):
+        self.write_string(relpath, json.dumps(obj, indent=indent))
+
+    def copy_file(self, src_fpath, relpath):
+        fpath = self.get_fpath(relpath)
+        digest = hash_file(src_fpath)
+        try:
+            unchanged = hash_file(fpath) == digest
+        except FileNotFoundError:
+            unchanged = False
+        if not unchanged:
+            os.makedirs(os.path.dirname(fpath), exist_ok=True)
+            shutil.copyfile(src_fpath, fpath)
+        self.record(relpath, digest)
+
+    def remove(self, relpath):
+        remove_file(self.get_fpath(relpath), self.output_dir)
+        self.hashes.pop(relpath, None)
+
+    def sync_dir(self, src_dir, relpath):
+        """Make output directory relpath a copy of src_dir."""
+        src_relpaths = set()
+        for dirpath, dirnames, fnames in os.walk(src_dir):
+            for fname in fnames:
+                fpath = pjoin(dirpath, fname)
+                relpath2 = relpath + '/' + get_relpath(fpath, src_dir)
+                src_relpaths.add(relpath2)
+                self.copy_file(fpath, relpath2)
+        stale_relpaths = {relpath2 for relpath2 in self.hashes
+            if relpath2.startswith(relpath + '/')} - src_relpaths
+        for dirpath, dirnames, fnames in os.walk(self.get_fpath(relpath)):
+            for fname in fnames:
+                relpath2 = get_relpath(pjoin(dirpath, fname), self.output_dir)
+                if relpath2 not in src_relpaths:
+                    stale_relpaths.add(relpath2)
+        for relpath2 in stale_relpaths:
+            self.remove(relpath2)
+
+    def get_changes(self):
+        changes = OrderedDict([('added', OrderedDict()), ('changed', OrderedDict()),
+            ('deleted', [])])
+        for relpath, digest in sorted(self.hashes.items()):
+            old_digest = self.old_hashes.get(relpath)
+            if old_digest is None:
+                changes['added'][relpath] = digest
+            elif old_digest != digest:
+                changes['changed'][relpath] = digest
+        changes['deleted'] = sorted(self.old_hashes.keys() - self.hashes.keys())
+        return changes
+
+    def save(self, store, intermediate_dir):
+        store.put('meta', 'outputs', OrderedDict(sorted(self.hashes.items())))
+        write_json_obj(self.get_changes(), pjoin(intermediate_dir, 'deploy_manifest.json'),
+            indent=4)
+
+
+def get_config(input_dir):
     config_json = pjoin(input_dir, 'config.json')
     try:
         config = read_json_obj(config_json)
@@ -76,17 +307,9 @@ def get_config(input_dir, intermediate_dir):
     config['DEBUG'] = debug
     if debug:
         config['SITEURL'] = None
-    config['LAST_RUN_TIME'] = read_timestamp(intermediate_dir)
-    config['THIS_RUN_TIME'] = time.time_ns()
     return config
 
 
 def get_relative_site_url_from_uci(uci):
     return ('../' * uci.count('/'))[:-1]
 
-
-def is_modified(fpath, last_run_time):
-    if last_run_time is None:
-        return True
-    else:
-        return os.path.getmtime(fpath) >= (last_run_time / 10**9)
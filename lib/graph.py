@@ -4,78 +4,521 @@ Class which represents a directed graph.
 Nodes are addressed by string labels.
 First call add_node with labels to add nodes.
 Then call add_edge with endpoint labels to add edges.
+Then optionally call freeze, which converts the graph to a compact read-only form.
 Then do whatever processing you want.
+
+transitive_closure works on the condensation of the graph (the DAG of SCCs).
+SCCs are laid out in topological order, so each vertex gets a position
+and the vertices of an SCC have contiguous positions.
+The vertices reachable from (or to) an SCC are stored as a bitset (a python int),
+whose bits are offset relative to the SCC's own position,
+so that a bitset's size depends on how far apart its vertices are in topological order.
+get_redundant_edges uses these bitsets to find the edges which the transitive reduction
+of the condensation leaves out.
+
+Vertices and edges can be added and removed after scc and transitive_closure
+(call thaw first if the graph is frozen). The SCCs, depths, topological order
+and transitive sets are then updated for the affected region only:
+* Adding an edge (u, v) where v's SCC is before u's in topological order
+  recomputes the SCCs in between (Pearce and Kelly's affected region),
+  which merge if the edge closes a cycle, and reorders them.
+  Their indices are reused, so SCCs outside the region keep their index,
+  and an SCC index may be left empty.
+* Removing an edge within an SCC recomputes that SCC, which may split.
+  The extra SCCs get new indices right after it, which shifts the indices of later SCCs.
+* The bitsets of SCCs which can reach (or be reached from) the changed SCCs
+  are then recomputed.
+* Otherwise only SCCs whose transitive sets change are updated. Those are found
+  by comparing the bitsets of the edge's endpoints, shifted to the same offset.
+A removed vertex keeps its index as an isolated vertex without a label,
+which is reused by the next vertex added.
+pop_changed returns the vertices whose derived values changed.
 """
 
+from array import array
 from collections import OrderedDict
+from heapq import heapify, heappush, heappop
+
+
+if hasattr(int, 'bit_count'):
+    def popcount(x):
+        return x.bit_count()
+else:
+    def popcount(x):
+        return bin(x).count('1')
+
+
+class CSRAdjacency:
+    """
+    Read-only adjacency lists in compressed sparse row form.
+    The neighbors of u are targets[offsets[u]:offsets[u+1]],
+    and label_ids is a column of edge label indices aligned with targets.
+    """
+
+    __slots__ = ('offsets', 'targets', 'label_ids')
+
+    def __init__(self, adj, get_label_id):
+        self.offsets = array('i', [0])
+        self.targets = array('i')
+        self.label_ids = array('i')
+        for u, nbrs in enumerate(adj):
+            self.targets.extend(nbrs)
+            if get_label_id is None:
+                self.label_ids.extend([-1] * len(nbrs))
+            else:
+                self.label_ids.extend([get_label_id(u, v) for v in nbrs])
+            self.offsets.append(len(self.targets))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, u):
+        return self.targets[self.offsets[u]: self.offsets[u + 1]]
+
+    def get_label_ids(self, u):
+        return self.label_ids[self.offsets[u]: self.offsets[u + 1]]
 
 
 class Graph:
 
+    __slots__ = ('label_to_index', 'index_to_label', 'adj', 'radj', 'edge_labels',
+        'edge_label_values', 'frozen', 'depth', 'topo_order', 'cclist', 'cc_start',
+        'position_to_index', 'treach', 'trreach', 'free_indices', 'changed')
+
     class VertexNotFound(ValueError):
         pass
 
+    class EdgeNotFound(ValueError):
+        pass
+
+    class FrozenError(RuntimeError):
+        pass
+
     def __init__(self):
         self.label_to_index = {}
         self.index_to_label = []
         self.adj = []
         self.radj = []
         self.edge_labels = {}
+        self.edge_label_values = None
+        self.frozen = False
         self.depth = None
         self.topo_order = None
-        self.tadj = None
-        self.tradj = None
+        self.cclist = None
+        self.cc_start = None
+        self.position_to_index = None
+        self.treach = None
+        self.trreach = None
+        # indices of removed vertices
+        self.free_indices = []
+        # indices of vertices whose derived values changed, see pop_changed
+        self.changed = set()
 
     def get_labels(self):
+        if self.free_indices:
+            return [label for label in self.index_to_label if label is not None]
         return self.index_to_label
 
+    def _get_index(self, label):
+        try:
+            return self.label_to_index[label]
+        except KeyError as e:
+            raise self.VertexNotFound(e.args[0])
+
     def add_vertex(self, label):
         if label not in self.label_to_index:
-            self.label_to_index[label] = len(self.index_to_label)
-            self.index_to_label.append(label)
-            self.adj.append([])
-            self.radj.append([])
+            if self.frozen:
+                raise self.FrozenError('cannot add vertex {} to a frozen graph'.format(label))
+            if self.free_indices:
+                # a removed vertex is isolated and is in an SCC of its own
+                u = self.free_indices.pop()
+                self.index_to_label[u] = label
+            else:
+                u = len(self.index_to_label)
+                self.index_to_label.append(label)
+                self.adj.append([])
+                self.radj.append([])
+                if self.topo_order is not None:
+                    self._append_isolated(u)
+            self.label_to_index[label] = u
+            if self.topo_order is not None:
+                self.changed.add(u)
+
+    def _append_isolated(self, u):
+        # put the new vertex u in a new SCC at the end of the topological order
+        self.depth.append(0)
+        self.topo_order.append(len(self.cclist))
+        self.cclist.append([u])
+        if self.treach is not None:
+            self.cc_start.append(self.cc_start[-1] + 1)
+            self.position_to_index.append(u)
+            self.treach.append(1)
+            self.trreach.append(1)
 
     def add_edge(self, label1, label2, edge_label=None):
         self.add_vertex(label1)
         self.add_vertex(label2)
+        if self.frozen:
+            raise self.FrozenError('cannot add edge to a frozen graph')
         u = self.label_to_index[label1]
         v = self.label_to_index[label2]
-        self.adj[u].append(v)
-        self.radj[v].append(u)
         if edge_label is not None:
             self.edge_labels[(u, v)] = edge_label
+        self._change_edge(u, v, True)
+
+    def remove_edge(self, label1, label2):
+        """Remove the edge from label1 to label2 (and any duplicates of it)."""
+        u = self._get_index(label1)
+        v = self._get_index(label2)
+        if self.frozen:
+            raise self.FrozenError('cannot remove edge from a frozen graph')
+        if v not in self.adj[u]:
+            raise self.EdgeNotFound('{} -> {}'.format(label1, label2))
+        self.edge_labels.pop((u, v), None)
+        self._change_edge(u, v, False)
+
+    def remove_vertex(self, label):
+        """Remove the vertex label and its edges."""
+        u = self._get_index(label)
+        if self.frozen:
+            raise self.FrozenError('cannot remove vertex {} from a frozen graph'.format(label))
+        for v in set(self.adj[u]):
+            self.remove_edge(label, self.index_to_label[v])
+        for v in set(self.radj[u]):
+            self.remove_edge(self.index_to_label[v], label)
+        del self.label_to_index[label]
+        self.index_to_label[u] = None
+        self.free_indices.append(u)
+
+    def pop_changed(self):
+        """
+        Labels of the vertices whose depth, topological order, SCC or transitive sets
+        were changed by adding or removing vertices and edges since the last call
+        (or since scc was called). New vertices count as changed.
+        """
+        labels = [self.index_to_label[u] for u in sorted(self.changed)
+            if self.index_to_label[u] is not None]
+        self.changed = set()
+        return labels
+
+    def _change_edge(self, u, v, add):
+        # add or remove the edge (u, v) and update derived data
+        if add:
+            self.adj[u].append(v)
+            self.radj[v].append(u)
+        else:
+            self.adj[u] = [w for w in self.adj[u] if w != v]
+            self.radj[v] = [w for w in self.radj[v] if w != u]
+        if self.topo_order is None:
+            return
+        cc = self.topo_order
+        cu, cv = cc[u], cc[v]
+        if (cu > cv) if add else (cu == cv and not self._reaches_within_scc(u, v)):
+            self._change_region(u, v, add)
+        elif cu != cv and self.treach is not None:
+            if add:
+                self._add_closure_edge(cu, cv)
+            else:
+                self._remove_closure_edge(cu, cv)
+        self._update_depths([v])
+
+    def _reaches_within_scc(self, u, v):
+        # whether there is a path from u to v in their SCC, in which case
+        # removing an edge (u, v) doesn't split the SCC
+        cc = self.topo_order
+        visited = {u}
+        stack = [u]
+        while stack:
+            x = stack.pop()
+            for y in self.adj[x]:
+                if y == v:
+                    return True
+                if cc[y] == cc[u] and y not in visited:
+                    visited.add(y)
+                    stack.append(y)
+        return u == v
+
+    def _change_region(self, u, v, add):
+        # the SCCs and topological order change, see _resolve_region
+        cc = self.topo_order
+        cu, cv = cc[u], cc[v]
+        has_closure = self.treach is not None
+        if has_closure:
+            # the bitsets don't know about the edge's change yet
+            old_anc_u = self._get_reach_indices(cu, reverse=True)
+            old_desc_v = self._get_reach_indices(cv, reverse=False)
+            if add:
+                old_anc_v = self._get_reach_indices(cv, reverse=True)
+                old_desc_u = self._get_reach_indices(cu, reverse=False)
+        region = self._resolve_region(cv, cu) if add else self._resolve_region(cu, cu)
+        if has_closure:
+            self._update_closure(region, region)
+            # x's descendants change iff x could reach u, and (when adding) couldn't reach v
+            # or (when removing) can't reach v any more, and similarly for ancestors
+            cu, cv = cc[u], cc[v]
+            if add:
+                self.changed |= old_anc_u - old_anc_v
+                self.changed |= old_desc_v - old_desc_u
+            else:
+                self.changed |= old_anc_u - self._get_reach_indices(cv, reverse=True)
+                self.changed |= old_desc_v - self._get_reach_indices(cu, reverse=False)
+        self._update_depths([w for cci in region for w in self.cclist[cci]])
+
+    def _add_closure_edge(self, cu, cv):
+        # an edge from SCC cu to a later SCC cv: SCCs which could reach cu but not cv
+        # now reach cv's descendants, and similarly for ancestors
+        start, treach, trreach = self.cc_start, self.treach, self.trreach
+        gained_desc = self._get_trreach_ccs(cu,
+            trreach[cu] & ~(trreach[cv] >> (start[cv + 1] - start[cu + 1])))
+        gained_anc = self._get_treach_ccs(cv,
+            treach[cv] & ~(treach[cu] >> (start[cv] - start[cu])))
+        for cci in gained_desc:
+            treach[cci] |= treach[cv] << (start[cv] - start[cci])
+        for cci in gained_anc:
+            trreach[cci] |= trreach[cu] << (start[cci + 1] - start[cu + 1])
+
+    def _remove_closure_edge(self, cu, cv):
+        # an edge from SCC cu to a later SCC cv: SCCs which could reach cu but can't reach cv
+        # any more are recomputed in reverse topological order, and similarly for ancestors
+        start, treach, trreach = self.cc_start, self.treach, self.trreach
+        old_trreach_cv = trreach[cv]
+        trreach[cv] = self._get_trreach(cv)
+        if trreach[cv] == old_trreach_cv:
+            # u still reaches v through other edges
+            return
+        lost_desc = self._get_trreach_ccs(cu,
+            trreach[cu] & ~(trreach[cv] >> (start[cv + 1] - start[cu + 1])))
+        for cci in sorted(lost_desc, reverse=True):
+            treach[cci] = self._get_treach(cci)
+        lost_anc = self._get_treach_ccs(cv,
+            treach[cv] & ~(treach[cu] >> (start[cv] - start[cu])))
+        for cci in sorted(lost_anc):
+            trreach[cci] = self._get_trreach(cci)
+
+    def _resolve_region(self, lo, hi):
+        """
+        Recompute the SCCs of the vertices in SCCs lo to hi and their topological order,
+        keeping the order of SCCs which don't have to move.
+        Returns the range of SCC indices which the region now spans.
+        """
+        cc = self.topo_order
+        has_closure = self.treach is not None
+        vertices = [u for cci in range(lo, hi + 1) for u in self.cclist[cci]]
+        in_region = set(vertices)
+        old_sets = {cci: frozenset(self.cclist[cci]) for cci in range(lo, hi + 1)}
+        sccs = self._get_sccs(vertices, in_region)
+
+        # stable topological sort of sccs, by the old index of their earliest vertex
+        new_scc = {u: i for i, vlist in enumerate(sccs) for u in vlist}
+        succs = [set() for vlist in sccs]
+        indegree = [0] * len(sccs)
+        for i, vlist in enumerate(sccs):
+            for u in vlist:
+                for w in self.adj[u]:
+                    j = new_scc.get(w, i)
+                    if j != i and j not in succs[i]:
+                        succs[i].add(j)
+                        indegree[j] += 1
+        heap = [(min([cc[u] for u in vlist]), i) for i, vlist in enumerate(sccs)
+            if indegree[i] == 0]
+        heapify(heap)
+        order = []
+        while heap:
+            key, i = heappop(heap)
+            order.append(i)
+            for j in succs[i]:
+                indegree[j] -= 1
+                if indegree[j] == 0:
+                    heappush(heap, (min([cc[u] for u in sccs[j]]), j))
+
+        extra = len(sccs) - (hi - lo + 1)
+        if extra > 0:
+            # make room after hi, which shifts the indices of later SCCs
+            self.cclist[hi + 1: hi + 1] = [[] for i in range(extra)]
+            if has_closure:
+                self.cc_start[hi + 1: hi + 1] = [self.cc_start[hi + 1]] * extra
+                self.treach[hi + 1: hi + 1] = [0] * extra
+                self.trreach[hi + 1: hi + 1] = [0] * extra
+            for cci in range(hi + 1 + extra, len(self.cclist)):
+                for u in self.cclist[cci]:
+                    cc[u] = cci
+                    self.changed.add(u)
+            hi += extra
+
+        position = self.cc_start[lo] if has_closure else None
+        for r, cci in enumerate(range(lo, hi + 1)):
+            vlist = sccs[order[r]] if r < len(order) else []
+            self.cclist[cci] = vlist
+            # if vlist was an SCC before, all its vertices had the same index
+            regrouped = bool(vlist) and old_sets[cc[vlist[0]]] != frozenset(vlist)
+            for u in vlist:
+                if regrouped or cc[u] != cci:
+                    self.changed.add(u)
+                cc[u] = cci
+            if has_closure:
+                self.cc_start[cci] = position
+                self.position_to_index[position: position + len(vlist)] = vlist
+                position += len(vlist)
+        return range(lo, hi + 1)
+
+    def _get_sccs(self, vertices, in_region):
+        # Kosaraju's algorithm on the subgraph induced by in_region, like scc()
+        visited = set()
+        fintime_order = []
+        for r in vertices:
+            if r not in visited:
+                visited.add(r)
+                stack = [(r, iter(self.adj[r]))]
+                while stack:
+                    u, nbrs = stack[-1]
+                    for v in nbrs:
+                        if v in in_region and v not in visited:
+                            visited.add(v)
+                            stack.append((v, iter(self.adj[v])))
+                            break
+                    else:
+                        stack.pop()
+                        fintime_order.append(u)
+        visited = set()
+        sccs = []
+        for r in reversed(fintime_order):
+            if r not in visited:
+                visited.add(r)
+                sccs.append([r])
+                stack = [r]
+                while stack:
+                    u = stack.pop()
+                    for v in self.radj[u]:
+                        if v in in_region and v not in visited:
+                            visited.add(v)
+                            sccs[-1].append(v)
+                            stack.append(v)
+        return sccs
+
+    def _update_closure(self, anc_seeds, desc_seeds):
+        # recompute treach for SCCs which can reach anc_seeds
+        # and trreach for SCCs reachable from desc_seeds
+        cc = self.topo_order
+
+        def collect(seeds, adj):
+            result = set(seeds)
+            stack = list(seeds)
+            while stack:
+                cci = stack.pop()
+                for u in self.cclist[cci]:
+                    for v in adj[u]:
+                        if cc[v] not in result:
+                            result.add(cc[v])
+                            stack.append(cc[v])
+            return result
+
+        for cci in sorted(collect(anc_seeds, self.radj), reverse=True):
+            self.treach[cci] = self._get_treach(cci)
+        for cci in sorted(collect(desc_seeds, self.adj)):
+            self.trreach[cci] = self._get_trreach(cci)
+
+    def _update_depths(self, seeds):
+        # recompute depths of seeds, and of their successors whose depth may have changed,
+        # in topological order
+        cc, depth = self.topo_order, self.depth
+        heap = [(cc[u], u) for u in seeds]
+        heapify(heap)
+        done = set()
+        while heap:
+            cci, u = heappop(heap)
+            if u in done:
+                continue
+            done.add(u)
+            d = max([depth[w] + 1 for w in self.radj[u] if cc[w] != cci], default=0)
+            if d != depth[u]:
+                depth[u] = d
+                self.changed.add(u)
+                for w in self.adj[u]:
+                    if cc[w] != cci:
+                        heappush(heap, (cc[w], w))
+
+    def thaw(self):
+        """Convert the graph back from the form made by freeze, keeping derived data."""
+        if not self.frozen:
+            return
+        self.edge_labels = {}
+        for u in range(len(self.adj)):
+            for v, label_id in zip(self.adj[u], self.adj.get_label_ids(u)):
+                if label_id != -1:
+                    self.edge_labels[(u, v)] = self.edge_label_values[label_id]
+        self.adj = [list(self.adj[u]) for u in range(len(self.adj))]
+        self.radj = [list(self.radj[u]) for u in range(len(self.radj))]
+        self.edge_label_values = None
+        for name in ('depth', 'topo_order', 'cc_start', 'position_to_index'):
+            if getattr(self, name) is not None:
+                setattr(self, name, list(getattr(self, name)))
+        self.frozen = False
+
+    def freeze(self):
+        """
+        Convert adj and radj to CSRAdjacency and intern edge labels.
+        Vertices and edges can't be added after this.
+        """
+        if self.frozen:
+            return
+        label_value_to_id = {}
+        self.edge_label_values = []
+
+        def get_label_id(u, v):
+            value = self.edge_labels.get((u, v))
+            if value is None:
+                return -1
+            label_id = label_value_to_id.get(value)
+            if label_id is None:
+                label_id = len(self.edge_label_values)
+                label_value_to_id[value] = label_id
+                self.edge_label_values.append(value)
+            return label_id
+
+        if self.edge_labels:
+            self.adj = CSRAdjacency(self.adj, get_label_id)
+            self.radj = CSRAdjacency(self.radj, (lambda v, u: get_label_id(u, v)))
+        else:
+            self.adj = CSRAdjacency(self.adj, None)
+            self.radj = CSRAdjacency(self.radj, None)
+        self.edge_labels = None
+        self.frozen = True
+
+    def _get_nbrs(self, u, adj, reverse):
+        res = OrderedDict()
+        if self.frozen:
+            for v, label_id in zip(adj[u], adj.get_label_ids(u)):
+                res[self.index_to_label[v]] = (None if label_id == -1
+                    else self.edge_label_values[label_id])
+        else:
+            for v in adj[u]:
+                res[self.index_to_label[v]] = self.edge_labels.get((v, u) if reverse else (u, v))
+        return res
 
     def get_radj(self, label):
         try:
             v = self.label_to_index[label]
         except KeyError as e:
             raise self.VertexNotFound(e.args[0])
-        res = OrderedDict()
-        for u in self.radj[v]:
-            res[self.index_to_label[u]] = self.edge_labels.get((u, v))
-        return res
+        return self._get_nbrs(v, self.radj, reverse=True)
 
     def get_degrees(self, label):
         try:
             u = self.label_to_index[label]
         except KeyError as e:
             raise self.VertexNotFound(e.args[0])
-        tin_nbrs = self.tradj[u]
-        tout_nbrs = self.tadj[u]
+        if self.treach is None:
+            return (len(self.radj[u]), len(self.adj[u]), None, None)
+        cci = self.topo_order[u]
         return (len(self.radj[u]), len(self.adj[u]),
-            None if tin_nbrs is None else len(tin_nbrs) - 1,
-            None if tout_nbrs is None else len(tout_nbrs) - 1)
+            popcount(self.trreach[cci]) - 1, popcount(self.treach[cci]) - 1)
 
     def get_adj(self, label):
         try:
             u = self.label_to_index[label]
         except KeyError as e:
             raise self.VertexNotFound(e.args[0])
-        res = OrderedDict()
-        for v in self.adj[u]:
-            res[self.index_to_label[v]] = self.edge_labels.get((u, v))
-        return res
+        return self._get_nbrs(u, self.adj, reverse=False)
 
     def get_depth(self, uci):
         if self.depth is None:
@@ -96,89 +539,231 @@ class Graph:
                 raise self.VertexNotFound(e.args[0])
 
     def get_tadj(self, uci):
-        if self.tadj is None:
+        """Vertices reachable from uci (including uci) in topological order."""
+        if self.treach is None:
             return None
-        else:
-            try:
-                tadju = self.tadj[self.label_to_index[uci]]
-                return [self.index_to_label[x] for x in tadju]
-            except KeyError as e:
-                raise self.VertexNotFound(e.args[0])
+        try:
+            cci = self.topo_order[self.label_to_index[uci]]
+        except KeyError as e:
+            raise self.VertexNotFound(e.args[0])
+        # bit i of treach[cci] is position cc_start[cci] + i
+        s = bin(self.treach[cci])[:1:-1]
+        return self._positions_to_labels(s, self.cc_start[cci])
 
     def get_tradj(self, uci):
-        if self.tradj is None:
+        """Vertices which can reach uci (including uci) in topological order."""
+        if self.trreach is None:
             return None
+        try:
+            cci = self.topo_order[self.label_to_index[uci]]
+        except KeyError as e:
+            raise self.VertexNotFound(e.args[0])
+        # bit i of trreach[cci] is position cc_start[cci + 1] - 1 - i
+        s = bin(self.trreach[cci])[2:]
+        indices = self._positions_to_indices(s, self.cc_start[cci + 1] - len(s))
+        cc, cclist = self.topo_order, self.cclist
+        if any(len(cclist[cc[u]]) > 1 for u in indices):
+            indices = self._get_tradj_dfs_order(self.label_to_index[uci])
+        return [self.index_to_label[u] for u in indices]
+
+    def _get_tradj_dfs_order(self, r):
+        # vertices which can reach r in preorder of a depth-first search from r on radj,
+        # stably sorted by SCC. This orders the vertices of an SCC the same way
+        # as transitive_closure did before it used bitsets.
+        visited = {r}
+        order = [r]
+        stack = [iter(self.radj[r])]
+        while stack:
+            for v in stack[-1]:
+                if v not in visited:
+                    visited.add(v)
+                    order.append(v)
+                    stack.append(iter(self.radj[v]))
+                    break
+            else:
+                stack.pop()
+        order.sort(key=self.topo_order.__getitem__)
+        return order
+
+    def _positions_to_indices(self, s, offset):
+        # s is a string of 0s and 1s, where s[j] says whether position offset + j is present
+        result = []
+        j = s.find('1')
+        while j != -1:
+            result.append(self.position_to_index[offset + j])
+            j = s.find('1', j + 1)
+        return result
+
+    def _positions_to_labels(self, s, offset):
+        return [self.index_to_label[u] for u in self._positions_to_indices(s, offset)]
+
+    def _get_reach_indices(self, cci, reverse):
+        # set of vertices which can reach SCC cci if reverse, else which are reachable from it
+        if reverse:
+            s = bin(self.trreach[cci])[2:]
+            return set(self._positions_to_indices(s, self.cc_start[cci + 1] - len(s)))
         else:
-            try:
-                tradju = self.tradj[self.label_to_index[uci]]
-                return [self.index_to_label[x] for x in tradju]
-            except KeyError as e:
-                raise self.VertexNotFound(e.args[0])
+            s = bin(self.treach[cci])[:1:-1]
+            return set(self._positions_to_indices(s, self.cc_start[cci]))
+
+    def _get_treach_ccs(self, cci, x):
+        # SCCs (which get marked as changed) of the positions in x, a bitset relative to cci
+        # like treach[cci]
+        s = bin(x)[:1:-1]
+        return self._get_changed_ccs(self._positions_to_indices(s, self.cc_start[cci]))
+
+    def _get_trreach_ccs(self, cci, x):
+        # like _get_treach_ccs, for a bitset relative to cci like trreach[cci]
+        s = bin(x)[2:]
+        return self._get_changed_ccs(self._positions_to_indices(s,
+            self.cc_start[cci + 1] - len(s)))
+
+    def _get_changed_ccs(self, vertices):
+        self.changed.update(vertices)
+        return {self.topo_order[u] for u in vertices}
+
+    def _get_treach(self, cci):
+        cc, start = self.topo_order, self.cc_start
+        vlist = self.cclist[cci]
+        x = (1 << len(vlist)) - 1
+        for ccj in {cc[v] for u in vlist for v in self.adj[u]}:
+            if ccj != cci:
+                x |= self.treach[ccj] << (start[ccj] - start[cci])
+        return x
+
+    def _get_trreach(self, cci):
+        cc, start = self.topo_order, self.cc_start
+        vlist = self.cclist[cci]
+        x = (1 << len(vlist)) - 1
+        for ccj in {cc[v] for u in vlist for v in self.radj[u]}:
+            if ccj != cci:
+                x |= self.trreach[ccj] << (start[cci + 1] - start[ccj + 1])
+        return x
 
     def transitive_closure(self):
-        n = len(self.adj)
-        self.tadj = [[] for i in range(n)]
-        self.tradj = [[] for i in range(n)]
-        visited = None
-
-        def visit(r, u, nbr_arr, tarr):
-            if u not in visited:
-                visited.add(u)
-                tarr.append(u)
-                for v in nbr_arr[u]:
-                    if v not in visited:
-                        visit(r, v, nbr_arr, tarr)
+        if self.topo_order is None:
+            self.scc()
+        k = len(self.cclist)
+        self.cc_start = [0] * (k + 1)
+        self.position_to_index = []
+        for cci, vlist in enumerate(self.cclist):
+            self.cc_start[cci + 1] = self.cc_start[cci] + len(vlist)
+            self.position_to_index += vlist
+        if self.frozen:
+            self.cc_start = array('i', self.cc_start)
+            self.position_to_index = array('i', self.position_to_index)
 
-        for r in range(n):
-            visited = set()
-            visit(r, r, self.adj, self.tadj[r])
-            visited = set()
-            visit(r, r, self.radj, self.tradj[r])
-            if self.topo_order is not None:
-                self.tradj[r].sort(key=(lambda x: self.topo_order[x]))
+        self.treach = [0] * k
+        for cci in reversed(range(k)):
+            self.treach[cci] = self._get_treach(cci)
+        self.trreach = [0] * k
+        for cci in range(k):
+            self.trreach[cci] = self._get_trreach(cci)
+
+    def get_redundant_edges(self):
+        """
+        Edges of the transitive reduction of the condensation which aren't needed,
+        i.e. edges (u, v) between different SCCs such that v's SCC is also reachable
+        from u through another predecessor w of v's SCC (which u can reach).
+        Returns an OrderedDict mapping each such (u, v) pair of labels to the label of w.
+        Computes the transitive closure if it wasn't computed.
+        """
+        if self.trreach is None:
+            self.transitive_closure()
+        cc = self.topo_order
+        start = self.cc_start
+        result = OrderedDict()
+        for cci, vlist in enumerate(self.cclist):
+            # predecessors of cci are visited closest first (in reverse topological order),
+            # so a redundant predecessor is always reachable from an earlier one.
+            # bit i of covered is position start[cci + 1] - 1 - i, like trreach.
+            covered = 0
+            kept = []
+            via = {}
+            for ccj in sorted({cc[u] for v in vlist for u in self.radj[v]} - {cci},
+                    reverse=True):
+                if (covered >> (start[cci + 1] - start[ccj + 1])) & 1:
+                    for cck in kept:
+                        if (self.trreach[cck] >> (start[cck + 1] - start[ccj + 1])) & 1:
+                            via[ccj] = cck
+                            break
+                else:
+                    kept.append(ccj)
+                    covered |= self.trreach[ccj] << (start[cci + 1] - start[ccj + 1])
+            if not via:
+                continue
+            # a predecessor of the SCC in each predecessor SCC, to report as w
+            pred_vertex = {}
+            for v in vlist:
+                for w in self.radj[v]:
+                    pred_vertex.setdefault(cc[w], w)
+            labels = self.index_to_label
+            for v in vlist:
+                for u in self.radj[v]:
+                    cck = via.get(cc[u])
+                    if cck is not None:
+                        result[(labels[u], labels[v])] = labels[pred_vertex[cck]]
+        return result
 
     def scc(self):
+        # Kosaraju's algorithm, with explicit stacks instead of recursion
+        # so that long dependency chains don't hit python's recursion limit.
         n = len(self.index_to_label)
         fintime_order = []
         visited = [False] * n
 
-        def visit1(u):
-            if not visited[u]:
-                visited[u] = True
-                for v in self.adj[u]:
-                    if not visited[v]:
-                        visit1(v)
-                fintime_order.append(u)
-
         for r in range(n):
             if not visited[r]:
-                visit1(r)
+                visited[r] = True
+                stack = [(r, iter(self.adj[r]))]
+                while stack:
+                    u, nbrs = stack[-1]
+                    for v in nbrs:
+                        if not visited[v]:
+                            visited[v] = True
+                            stack.append((v, iter(self.adj[v])))
+                            break
+                    else:
+                        stack.pop()
+                        fintime_order.append(u)
 
         visited = [False] * n
         cc = [-1] * n
         cclist = []
-        self.depth = [0] * n
-
-        def visit2(u, cci):
-            if not visited[u]:
-                visited[u] = True
-                cc[u] = cci
-                cclist[-1].append(u)
-                for v in self.radj[u]:
-                    if cc[v] != cc[u] and cc[v] != -1:
-                        self.depth[u] = max(self.depth[u], self.depth[v] + 1)
-                    if not visited[v]:
-                        visit2(v, cci)
+        depth = [0] * n
 
         cci = 0
         for r in reversed(fintime_order):
             if not visited[r]:
-                cclist.append([])
-                visit2(r, cci)
+                visited[r] = True
+                cc[r] = cci
+                cclist.append([r])
+                stack = [(r, iter(self.radj[r]))]
+                while stack:
+                    u, nbrs = stack[-1]
+                    for v in nbrs:
+                        if cc[v] != cc[u] and cc[v] != -1:
+                            depth[u] = max(depth[u], depth[v] + 1)
+                        if not visited[v]:
+                            visited[v] = True
+                            cc[v] = cci
+                            cclist[-1].append(v)
+                            stack.append((v, iter(self.radj[v])))
+                            break
+                    else:
+                        stack.pop()
                 cci += 1
 
+        if self.frozen:
+            depth, cc = array('i', depth), array('i', cc)
+        self.depth = depth
         self.topo_order = cc
-        cclist2 = [[self.index_to_label[u] for u in l] for l in cclist]
+        self.cclist = cclist
+        self.treach = self.trreach = None
+        self.changed = set()
+        # removed vertices are left out
+        cclist2 = [[self.index_to_label[u] for u in l if self.index_to_label[u] is not None]
+            for l in cclist]
         return cclist2
 
 
@@ -0,0 +1,209 @@
+"""
+Lay out graphs with graphviz.
+
+The layout of the whole graph (graph.svg) is skipped if the DOT source and the engine
+are the same as in the last build whose layout succeeded, which is checked using a hash
+stored in the build manifest. Otherwise, it runs as a background process (LayoutJob).
+
+The layouts of partitions of the graph (like sections and neighborhoods of nodes)
+are run in the background by a LayoutPool, a few graphviz processes at a time.
+Their SVGs are cached in a directory by the hash of their DOT source and engine,
+so that only partitions whose DOT source changed are laid out again.
+"""
+
+import os
+from os.path import join as pjoin
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import profile
+from .common import hash_string, write_string_to_file
+
+GRAPH_LAYOUT_KEY = 'graph.svg'
+DEFAULT_ENGINE = 'dot'
+# output directory for the layouts of partitions
+GRAPHS_DIR = 'graphs'
+
+
+def get_layout_options(config):
+    """Returns the graphviz engine and the timeout in seconds (None for no timeout)."""
+    return (config.get('DOT_ENGINE', DEFAULT_ENGINE), config.get('DOT_TIMEOUT'))
+
+
+def remove_files(*fpaths):
+    for fpath in fpaths:
+        try:
+            os.remove(fpath)
+        except FileNotFoundError:
+            pass
+
+
+class LayoutJob:
+
+    def __init__(self, engine, dot_fpath, svg_fpath, timeout=None):
+        self.engine = engine
+        self.svg_fpath = svg_fpath
+        self.temp_fpath = svg_fpath + '.tmp'
+        self.timeout = timeout
+        self.start_time = time.perf_counter()
+        # raises FileNotFoundError if the engine isn't installed
+        self.proc = subprocess.Popen([engine, '-Tsvg', dot_fpath, '-o', self.temp_fpath])
+        self.success = None
+
+    def join(self):
+        """Wait for the layout to finish and returns whether it succeeded."""
+        if self.success is not None:
+            return self.success
+        timeout = None
+        if self.timeout is not None:
+            timeout = max(0, self.timeout - (time.perf_counter() - self.start_time))
+        try:
+            returncode = self.proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+            print('{} timed out after {} seconds, not generating {}'.format(
+                self.engine, self.timeout, self.svg_fpath), file=sys.stderr)
+            returncode = None
+        # the process may have finished before join was called
+        profile.add_span('graphviz', self.start_time, time.perf_counter(), engine=self.engine,
+            output=os.path.basename(self.svg_fpath))
+        self.success = returncode == 0
+        if self.success:
+            os.replace(self.temp_fpath, self.svg_fpath)
+        else:
+            if returncode is not None:
+                print('{} failed with exit code {}, not generating {}'.format(
+                    self.engine, returncode, self.svg_fpath), file=sys.stderr)
+            # the layout of an earlier build doesn't match the graph any more
+            remove_files(self.temp_fpath, self.svg_fpath)
+        return self.success
+
+
+class ManifestLayoutJob(LayoutJob):
+    """A LayoutJob which records the layout's hash in the manifest if it succeeds."""
+
+    def __init__(self, manifest, key, digest, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.manifest = manifest
+        self.key = key
+        self.digest = digest
+
+    def join(self):
+        success = super().join()
+        if success:
+            self.manifest.hashes[self.key] = self.digest
+        return success
+
+
+def start_layout(manifest, key, dot_source, dot_fpath, svg_fpath, engine, timeout=None):
+    """
+    Write dot_source to dot_fpath and lay it out into svg_fpath.
+    Returns a job to join, or None if nothing needs to be done or the engine isn't installed.
+    """
+    write_string_to_file(dot_source, dot_fpath)
+    digest = hash_string(engine + '\n' + dot_source)
+    if manifest.old_hashes.get(key) == digest and os.path.exists(svg_fpath):
+        manifest.hashes[key] = digest
+        return None
+    try:
+        return ManifestLayoutJob(manifest, key, digest, engine, dot_fpath, svg_fpath,
+            timeout=timeout)
+    except FileNotFoundError:
+        print('{} is not installed, not generating {}'.format(engine, svg_fpath),
+            file=sys.stderr)
+        remove_files(svg_fpath)
+        return None
+
+
+def run_layout(engine, dot_source, svg_fpath, timeout=None):
+    """Lay out dot_source into svg_fpath. Returns svg_fpath, or None if the layout failed."""
+    dot_fpath = svg_fpath[:-len('.svg')] + '.dot'
+    temp_fpath = svg_fpath + '.tmp'
+    write_string_to_file(dot_source, dot_fpath)
+    try:
+        with profile.span('graphviz', engine=engine, output=os.path.basename(svg_fpath)):
+            subprocess.run([engine, '-Tsvg', dot_fpath, '-o', temp_fpath], check=True,
+                timeout=timeout)
+        os.replace(temp_fpath, svg_fpath)
+        return svg_fpath
+    except (OSError, subprocess.SubprocessError):
+        return None
+    finally:
+        remove_files(dot_fpath, temp_fpath)
+
+
+class LayoutPool:
+
+    def __init__(self, cache_dir, engine, timeout=None, jobs=1):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.engine = engine
+        self.timeout = timeout
+        # the layouts themselves run in graphviz processes, so threads are enough to wait on them
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.results = OrderedDict()
+        self.used_fnames = set()
+
+    def submit(self, key, dot_source):
+        fname = hash_string(self.engine + '\n' + dot_source) + '.svg'
+        self.used_fnames.add(fname)
+        svg_fpath = pjoin(self.cache_dir, fname)
+        if os.path.exists(svg_fpath):
+            self.results[key] = svg_fpath
+        else:
+            self.results[key] = self.executor.submit(run_layout, self.engine, dot_source,
+                svg_fpath, self.timeout)
+
+    def join(self):
+        """
+        Wait for all layouts to finish. Returns an OrderedDict mapping keys
+        to the paths of their SVGs, or to None for layouts which failed.
+        SVGs in cache_dir which weren't submitted are removed.
+        """
+        results = OrderedDict()
+        n_failed = 0
+        for key, result in self.results.items():
+            if not isinstance(result, str):
+                result = result.result()
+                if result is None:
+                    n_failed += 1
+            results[key] = result
+        self.executor.shutdown()
+        if n_failed:
+            print('{} of {} graph layouts with {} failed'.format(
+                n_failed, len(results), self.engine), file=sys.stderr)
+        for fname in os.listdir(self.cache_dir):
+            if fname not in self.used_fnames:
+                os.remove(pjoin(self.cache_dir, fname))
+        return results
+
+
+class Layouts:
+    """
+    Layouts started by process.process_all,
+    which render.render_all joins and copies to output_dir.
+    """
+
+    def __init__(self, graph_job=None, pool=None):
+        self.graph_job = graph_job
+        self.pool = pool
+
+    def join(self, outputs):
+        """
+        Wait for the layouts, and copy the layouts of partitions to outputs,
+        keyed by their path relative to output_dir.
+        """
+        if self.graph_job is not None:
+            self.graph_job.join()
+        svgs = self.pool.join() if self.pool is not None else {}
+        for relpath, svg_fpath in svgs.items():
+            if svg_fpath is not None:
+                outputs.copy_file(svg_fpath, relpath)
+        # remove layouts of partitions which no longer exist
+        for relpath in [relpath for relpath in outputs.hashes
+                if relpath.startswith(GRAPHS_DIR + '/') and relpath not in svgs]:
+            outputs.remove(relpath)
@@ -6,18 +6,25 @@ easy-for-computer-to-read format.
 """
 
 import argparse
+import hashlib
 import json
 import os
 from os.path import join as pjoin
 from collections import OrderedDict
 from collections.abc import Mapping, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from urllib.parse import urljoin
 
+import markdown
 from markdown import Markdown
+from . import profile
+from .cache import DiskCache
 from .common import (
-    read_json_obj, write_json_obj, write_string_to_file, get_uci_fpath_list,
-    get_relative_site_url_from_uci, is_modified
+    read_json_obj, get_uci_fpath_list, get_relative_site_url_from_uci, get_relpath,
+    get_node_relpath, get_node_fragment_relpath, hash_string,
     )
+from .store import UCI_KINDS
 from .tex_md_escape import tex_md_escape
 
 
@@ -26,6 +33,8 @@ def jsonpath_to_string(jsonpath):
 
 
 global_markdown = None
+global_conversion_cache = None
+MARKDOWN_EXTENSIONS = ['fenced_code']
 KNOWN_FORMATS = ('html', 'txt', 'raw', 'tex', 'md', 'mdonly')
 TYPE_FROM_STRING = {
     'string': str,
@@ -39,18 +48,58 @@ TYPE_FROM_STRING = {
 def get_markdown_instance():
     global global_markdown
     if global_markdown is None:
-        global_markdown = Markdown(extensions=['fenced_code'])
+        global_markdown = Markdown(extensions=MARKDOWN_EXTENSIONS)
     return global_markdown
 
 
+def set_conversion_cache(cache_dir, max_size):
+    global global_conversion_cache
+    if max_size > 0:
+        global_conversion_cache = DiskCache(cache_dir, max_size)
+    else:
+        global_conversion_cache = None
+    return global_conversion_cache
+
+
+def init_worker(cache_dir, cache_size):
+    # every worker process should create its own Markdown instance
+    global global_markdown
+    global_markdown = None
+    set_conversion_cache(cache_dir, cache_size)
+
+
+def get_conversion_key(text, format):
+    h = hashlib.sha256()
+    for part in (format, ','.join(MARKDOWN_EXTENSIONS), markdown.__version__, text):
+        h.update(part.encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
 def convert_to_html(text, format):
     if format in ('html', 'txt', 'raw'):
         return text
-    elif format is None or format in ('tex', 'md'):
-        text2 = tex_md_escape(text)
-        return get_markdown_instance().convert(text2)
-    elif format == 'mdonly':
-        return get_markdown_instance().convert(text)
+    if format in (None, 'tex', 'md'):
+        format = 'tex'
+    elif format != 'mdonly':
+        return None
+
+    cache = global_conversion_cache
+    if cache is not None:
+        key = get_conversion_key(text, format)
+        html = cache.get(key)
+        if html is not None:
+            profile.count('conversion_cache_hits')
+            return html
+        profile.count('conversion_cache_misses')
+    with profile.span('convert_to_html', format=format, size=len(text)):
+        if format == 'tex':
+            html = get_markdown_instance().convert(tex_md_escape(text))
+        else:
+            html = get_markdown_instance().convert(text)
+    if cache is not None:
+        cache.put(key, html)
+    return html
 
 
 def headingify(text, level):
@@ -62,10 +111,9 @@ def linkify(text, url):
 
 
 class InputJsonParser:
-    def __init__(self, input_dir, intermediate_dir, uci, config):
+    def __init__(self, input_dir, uci, config):
         # siteurl should end with a slash if it contains a subdirectory
         self.input_dir = input_dir
-        self.intermediate_dir = intermediate_dir
         self.uci = uci
         self.config = config
         self.siteurl = config.get('SITEURL')
@@ -89,6 +137,10 @@ class InputJsonParser:
             self.uci = uci
             self.jsonpath = jsonpath
 
+        def __reduce__(self):
+            # needed to send ParseErrors from worker processes to the parent
+            return (rebuild_parse_error, (type(self), self.args, self.uci, self.jsonpath))
+
         def __str__(self):
             parts = []
             s = jsonpath_to_string(self.jsonpath)
@@ -284,9 +336,11 @@ class InputJsonParser:
         if x is None:
             return 'ok'
         elif not isinstance(x, str):
-            raise self.ParseTypeError('invalid_type', 'expected string')
+            raise self.ParseTypeError('invalid_type', 'expected string',
+                uci=self.uci, jsonpath=jsonpath)
         elif x not in InputJsonParser.STATUSES:
-            raise self.ParseError('invalid_value', 'not in {}'.format(InputJsonParser.STATUSES))
+            raise self.ParseError('invalid_value', 'not in {}'.format(InputJsonParser.STATUSES),
+                uci=self.uci, jsonpath=jsonpath)
         return x
 
     def parse_input(self, d, jsonpath=()):
@@ -307,31 +361,108 @@ class InputJsonParser:
         return (d2, doc_lines, doc_paths)
 
 
-def process_all(input_dir, intermediate_dir, config, indent=4):
-    uci_input_fpath_list = get_uci_fpath_list(pjoin(input_dir, 'nodes'))
-    some_json_changed = False
-    modified_ucis = set()
-    for uci, input_fpath in uci_input_fpath_list:
-        output_fpath = pjoin(intermediate_dir, 'json1', uci[1:] + '.json')
-        parser = InputJsonParser(input_dir, intermediate_dir, uci=uci, config=config)
-        d = read_json_obj(input_fpath)
-        d2, doc_lines, doc_paths = parser.parse_input(d)
-        json_changed = is_modified(input_fpath, config['LAST_RUN_TIME'])
-        if json_changed:
-            some_json_changed = True
-            write_json_obj(d2, output_fpath, indent=indent)
-        output_fpath2 = pjoin(intermediate_dir, 'pages', uci[1:] + '.html')
-        doc_modified = any([is_modified(doc_path, config['LAST_RUN_TIME'])
-            for doc_path in doc_paths])
+def rebuild_parse_error(cls, args, uci, jsonpath):
+    return cls(*args, uci=uci, jsonpath=jsonpath)
+
+
+def parse_node(input_dir, config, manifest, config_changed, uci, input_fpath):
+    """
+    Parse a node's JSON file and convert its document to HTML.
+    Nothing is parsed if neither the node's JSON file, its include files
+    nor the config have changed since the last build.
+    Returns a tuple (json_changed, page_changed, d2, document, hashes, include_keys),
+    where hashes are the content hashes of the input files that were looked at.
+    d2 is None if json_changed is False.
+    document is None if page_changed is False or if the node has no document.
+    """
+    with profile.span('parse node', uci=uci):
+        json_key = get_relpath(input_fpath, input_dir)
+        json_changed = manifest.is_modified(json_key, manifest.hash_file(json_key, input_fpath))
+        json_changed = json_changed or config_changed
+        old_include_keys = manifest.old_node_includes.get(uci)
+        if not json_changed and old_include_keys is not None:
+            include_keys = old_include_keys
+            doc_modified = any([manifest.is_modified(key,
+                    manifest.hash_file(key, pjoin(input_dir, key)))
+                for key in include_keys])
+        else:
+            doc_modified = True
+
+        d2, document = None, None
         if json_changed or doc_modified:
-            modified_ucis.add(uci)
+            parser = InputJsonParser(input_dir, uci=uci, config=config)
+            d = read_json_obj(input_fpath)
+            d2, doc_lines, doc_paths = parser.parse_input(d)
+            include_keys = [get_relpath(doc_path, input_dir) for doc_path in doc_paths]
+            for key, doc_path in zip(include_keys, doc_paths):
+                manifest.hash_file(key, doc_path)
+            if not json_changed:
+                d2 = None
             if doc_lines:
                 for i, line in enumerate(doc_lines):
                     if not isinstance(line, str):
                         doc_lines[i] = line()
                 document = '\n'.join(doc_lines)
-                write_string_to_file(document, output_fpath2)
-    return (some_json_changed, modified_ucis)
+
+        hashes = {key: manifest.hashes[key] for key in [json_key] + include_keys}
+    return (json_changed, json_changed or doc_modified, d2, document, hashes, include_keys)
+
+
+def prune_deleted_nodes(store, outputs, ucis):
+    for uci in ucis:
+        for kind in UCI_KINDS:
+            store.delete(kind, uci)
+        outputs.remove(get_node_relpath(uci))
+        outputs.remove(get_node_fragment_relpath(uci))
+
+
+def process_all(input_dir, intermediate_dir, store, outputs, config, manifest, jobs=1,
+        cache_size=0):
+    """
+    Returns a pair (changed_ucis, modified_ucis).
+    changed_ucis are the nodes whose JSON changed, including deleted nodes.
+    modified_ucis are the nodes whose JSON or document changed.
+    Intermediate records and output pages of deleted nodes are removed.
+    """
+    uci_input_fpath_list = get_uci_fpath_list(pjoin(input_dir, 'nodes'))
+    ucis = [uci for uci, input_fpath in uci_input_fpath_list]
+    input_fpaths = [input_fpath for uci, input_fpath in uci_input_fpath_list]
+    config_changed = manifest.is_modified('config', hash_string(json.dumps(config)))
+    func = partial(parse_node, input_dir, config, manifest, config_changed)
+    # deleted nodes count as changed
+    deleted_ucis = (manifest.old_node_includes.keys() | set(store.keys('json1'))) - set(ucis)
+    prune_deleted_nodes(store, outputs, deleted_ucis)
+    changed_ucis = set(deleted_ucis)
+    modified_ucis = set()
+
+    def merge_results(results):
+        # results arrive in the same order as uci_input_fpath_list
+        for uci, result in zip(ucis, results):
+            json_changed, page_changed, d2, document, hashes, include_keys = result
+            if json_changed:
+                changed_ucis.add(uci)
+                store.put('json1', uci, d2)
+            if page_changed:
+                modified_ucis.add(uci)
+                if document is None:
+                    store.delete('pages', uci)
+                else:
+                    store.put('pages', uci, document)
+            manifest.hashes.update(hashes)
+            manifest.node_includes[uci] = include_keys
+
+    cache_dir = pjoin(intermediate_dir, 'conversion_cache')
+    cache = set_conversion_cache(cache_dir, cache_size)
+    if jobs > 1 and len(ucis) > 1:
+        chunksize = max(1, len(ucis) // (4 * jobs))
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                initargs=(cache_dir, cache_size)) as executor:
+            merge_results(executor.map(func, ucis, input_fpaths, chunksize=chunksize))
+    else:
+        merge_results(map(func, ucis, input_fpaths))
+    if cache is not None and (changed_ucis or modified_ucis):
+        cache.evict()
+    return (changed_ucis, modified_ucis)
 
 
 def main():
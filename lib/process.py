@@ -5,18 +5,27 @@ Read low-level intermediate files and process them to create high-level intermed
 These high-level files include some final output and context for the renderer.
 """
 
-import sys
 import os
+import shutil
 import argparse
 from os.path import join as pjoin
 import json
 from collections import OrderedDict
 from collections import abc
+from operator import itemgetter
 from urllib.parse import urljoin
-import subprocess
 
-from .common import get_uci_fpath_list, read_json_obj, write_json_obj
+from .common import read_json_obj, hash_string
 from .graph import Graph
+from . import search, layout, profile
+
+# change this when the format of render contexts changes, so that all of them are rewritten
+CONTEXT_VERSION = 1
+
+
+def is_context_outdated(manifest):
+    """Whether render contexts were written by a build with a different CONTEXT_VERSION."""
+    return manifest.is_modified('context_version', str(CONTEXT_VERSION))
 
 
 class JsonProcessor:
@@ -46,36 +55,26 @@ class JsonProcessor:
             return html_path
 
     def get_deps_context(self, d):
+        # references to dependencies as [uci, reason] pairs, resolved by the renderer
         d2 = []
         for i, deps in enumerate(d):
-            d3 = []
             if isinstance(deps, abc.Mapping):
                 g = deps.items()
             elif isinstance(deps, abc.Sequence):
                 g = ((x, None) for x in deps)
             else:
                 raise TypeError("d[{}] should be a Mapping or a Sequence".format(i))
-            for uci2, reason in g:
-                try:
-                    obj2 = self.data[uci2]
-                    # deps2 = obj2['deps']
-                    metadata2 = obj2['metadata']
-                    status2, deps_status2 = obj2['status'], obj2['deps_status']
-                except KeyError:
-                    metadata2 = None
-                    status2, deps_status2 = None, None
-                d4 = OrderedDict([
-                    ('uci', uci2),
-                    ('exists', uci2 in self.data),
-                    ('reason', reason),
-                    ('status', status2),
-                    ('deps_status', deps_status2),
-                    ('metadata', metadata2),
-                ])
-                d3.append(d4)
-            d2.append(d3)
+            d2.append([[uci2, reason] for uci2, reason in g])
         return d2
 
+    def get_node_table(self):
+        """Data of every node which dependency lists show, shared by all render contexts."""
+        return OrderedDict((uci, OrderedDict([
+            ('status', d['status']),
+            ('deps_status', d['deps_status']),
+            ('metadata', d['metadata']),
+        ])) for uci, d in self.data.items())
+
     def get_search_obj(self, d, uci, search_sep=' $ '):
         obj = OrderedDict(d['metadata'])
         obj['uci'] = uci
@@ -83,9 +82,34 @@ class JsonProcessor:
         if d['status'] != 'ok':
             obj['status'] = d['status']
         if self.config.get('SEARCH_FIELDS') is None:
-            obj['search'] = search_sep.join(d['metadata'].values())
+            obj[search.ALL_METADATA_FIELD] = search_sep.join(d['metadata'].values())
         return obj
 
+    def get_structure_hash(self, d, uci):
+        """
+        Hash of the parts of uci's render context that depend on the graph's structure,
+        i.e. everything except the data of uci and of its neighbors.
+        """
+        deps = [[(uci2, uci2 in self.data, reason) for uci2, reason in deps.items()]
+            for deps in d['deps']]
+        obj = [CONTEXT_VERSION, self.graph.get_depth(uci), self.graph.get_topo_order(uci),
+            self.graph.get_degrees(uci), deps, list(self.graph.get_adj(uci).items()),
+            self.graph.get_tradj(uci)]
+        return hash_string(json.dumps(obj))
+
+    def get_affected_ucis(self, changed_ucis):
+        """
+        Get the nodes whose render context contains data of a node in changed_ucis.
+        """
+        affected = set()
+        for uci in changed_ucis:
+            try:
+                affected.update(self.graph.get_radj(uci))
+                affected.update(self.graph.get_tadj(uci))
+            except Graph.VertexNotFound:
+                pass
+        return affected
+
     def get_context(self, d, uci, find_tdeps):
         d2 = OrderedDict()
         d2['depth'] = self.graph.get_depth(uci)
@@ -97,7 +121,7 @@ class JsonProcessor:
         d2['rdeps'] = self.get_deps_context([self.graph.get_adj(uci)])[0]
         tradj = self.graph.get_tradj(uci)
         tradj.remove(uci)
-        d2['tdeps'] = self.get_deps_context([tradj])[0]
+        d2['tdeps'] = tradj
         return d2
 
 
@@ -130,14 +154,127 @@ def add_to_index_tree(tree, uci, url, metadata, graph, status, deps_status):
             }
 
 
-def process_all(input_dir, intermediate_dir, output_dir, config):
-    # read data from file
-    uci_fpath_list_1 = get_uci_fpath_list(pjoin(intermediate_dir, 'json1'))
+def get_dot_source(data, ucis=None, highlight=None, skip_edges=()):
+    """
+    DOT source of the subgraph induced by the nodes in the sorted list ucis,
+    or of the whole graph, including missing dependencies, if ucis is None.
+    The node highlight is drawn in bold.
+    Edges (uci2, uci) in skip_edges are left out.
+    """
+    uci_set = None if ucis is None else set(ucis)
+    items = data.items() if ucis is None else [(uci, data[uci]) for uci in ucis]
+    lines = ['digraph concepdag {']
+    for uci, d in items:
+        attrs = []
+        label = d['metadata'].get('title')
+        if label is not None:
+            attrs.append('label="{}"'.format(label))
+        if uci == highlight:
+            attrs.append('style=bold')
+        if attrs:
+            lines.append('"{}" [{}]'.format(uci, ', '.join(attrs)))
+        elif uci_set is not None:
+            lines.append('"{}"'.format(uci))
+    for uci, d in items:
+        for deps in d['deps']:
+            for uci2, reason in deps.items():
+                if uci_set is not None and uci2 not in uci_set or (uci2, uci) in skip_edges:
+                    continue
+                if reason is None:
+                    lines.append('"{}" -> "{}"'.format(uci2, uci))
+                else:
+                    lines.append('"{}" -> "{}" [label="{}"]'.format(uci2, uci, reason))
+    lines.append('}')
+    return ''.join(line + '\n' for line in lines)
+
+
+def get_sections(data):
+    """Map each top-level section (as in the index tree) to the sorted list of its nodes."""
+    sections = OrderedDict()
+    for uci in data:
+        parts = uci[1:].split('/')
+        if len(parts) > 1:
+            sections.setdefault(parts[0], []).append(uci)
+    for ucis in sections.values():
+        ucis.sort()
+    return sections
+
+
+def get_neighborhood(data, graph, uci, hops, max_nodes):
+    """
+    Sorted list of the nodes at most hops edges away from uci (in either direction),
+    closest first, stopping at max_nodes nodes.
+    """
+    seen = {uci}
+    frontier = [uci]
+    for i in range(hops):
+        next_frontier = []
+        for u in frontier:
+            for v in list(graph.get_radj(u)) + list(graph.get_adj(u)):
+                if v not in seen and v in data:
+                    if len(seen) >= max_nodes:
+                        return sorted(seen)
+                    seen.add(v)
+                    next_frontier.append(v)
+        frontier = next_frontier
+    return sorted(seen)
+
+
+def get_redundant_deps(graph):
+    """
+    Map each node to its dependencies which are also indirect dependencies
+    through another of its dependencies, which they are mapped to.
+    """
+    redundant_deps = OrderedDict()
+    for (uci2, uci), via in graph.get_redundant_edges().items():
+        redundant_deps.setdefault(uci, OrderedDict())[uci2] = via
+    return redundant_deps
+
+
+def start_layouts(intermediate_dir, config, manifest, data, graph, jobs, redundant_edges=()):
+    """
+    Start laying out the whole graph and its partitions, as enabled by config.
+    redundant_edges are left out of the whole graph if config['DOT_TRANSITIVE_REDUCTION'].
+    """
+    layouts = layout.Layouts()
+    cache_dir = pjoin(intermediate_dir, 'layout_cache')
+    hops = config.get('NEIGHBORHOOD_GRAPH_HOPS')
+    if 'dot' in config['DISABLE'] or not (config.get('SECTION_GRAPHS') or hops):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    if 'dot' in config['DISABLE']:
+        return layouts
+    engine, timeout = layout.get_layout_options(config)
+    skip_edges = redundant_edges if config.get('DOT_TRANSITIVE_REDUCTION') else ()
+    layouts.graph_job = layout.start_layout(manifest, layout.GRAPH_LAYOUT_KEY,
+        get_dot_source(data, skip_edges=skip_edges), pjoin(intermediate_dir, 'graph.dot'),
+        pjoin(intermediate_dir, 'graph.svg'), engine, timeout)
+
+    if config.get('SECTION_GRAPHS') or hops:
+        pool = layout.LayoutPool(cache_dir, engine, timeout, jobs)
+        if config.get('SECTION_GRAPHS'):
+            for section, ucis in get_sections(data).items():
+                pool.submit('{}/sections/{}.svg'.format(layout.GRAPHS_DIR, section),
+                    get_dot_source(data, ucis))
+        if hops:
+            max_nodes = config.get('NEIGHBORHOOD_GRAPH_MAX_NODES', 100)
+            for uci in data:
+                ucis = get_neighborhood(data, graph, uci, hops, max_nodes)
+                pool.submit('{}/nodes{}.svg'.format(layout.GRAPHS_DIR, uci),
+                    get_dot_source(data, ucis, highlight=uci))
+        layouts.pool = pool
+    return layouts
+
+
+def build_graph(store):
+    """
+    Read json1 records from store and build the frozen dependency graph.
+    Returns (data, graph, broken_deps), where broken_deps maps missing UCIs to their dependents.
+    """
     data = OrderedDict()
     graph = Graph()
-    for uci, fpath1 in uci_fpath_list_1:
+    # in a canonical order, since the order of a store's records depends on its history
+    for uci, d in sorted(store.items('json1'), key=itemgetter(0)):
         graph.add_vertex(uci)
-        d = read_json_obj(fpath1)
         data[uci] = d
 
     # add edges to graph and detect broken dependencies
@@ -151,34 +288,28 @@ def process_all(input_dir, intermediate_dir, output_dir, config):
                         broken_deps[uci2] = [uci]
                     else:
                         broken_deps[uci2].append(uci)
+    graph.freeze()
+    return (data, graph, broken_deps)
+
+
+def process_all(input_dir, intermediate_dir, outputs, store, config, manifest, changed_ucis,
+        jobs=1):
+    """
+    Returns a pair (render_ucis, layouts).
+    render_ucis is the set of nodes whose page has to be rendered again.
+    layouts is a layout.Layouts of graph.svg and partitions of the graph,
+    which run in the background (with at most jobs graphviz processes) and have to be joined.
+    """
+    with profile.span('build_graph'):
+        data, graph, broken_deps = build_graph(store)
     with open(pjoin(intermediate_dir, 'broken_deps.json'), 'w') as fp:
         json.dump(broken_deps, fp, indent=4)
 
-    if 'dot' not in config['DISABLE']:
-        with open(pjoin(intermediate_dir, 'graph.dot'), 'w') as fp:
-            print('digraph concepdag {', file=fp)
-            for uci, d in data.items():
-                label = d['metadata'].get('title')
-                if label is not None:
-                    print('"{}" [label="{}"]'.format(uci, label), file=fp)
-            for uci, d in data.items():
-                for deps in d['deps']:
-                    for uci2, reason in deps.items():
-                        if reason is None:
-                            print('"{}" -> "{}"'.format(uci2, uci), file=fp)
-                        else:
-                            print('"{}" -> "{}" [label="{}"]'.format(uci2, uci, reason), file=fp)
-            print('}', file=fp)
-
-        try:
-            subprocess.check_call(['dot', '-Tsvg', pjoin(intermediate_dir, 'graph.dot'), '-o',
-                pjoin(intermediate_dir, 'graph.svg')])
-        except FileNotFoundError:
-            print('dot is not installed, not generating graph', file=sys.stderr)
-
     # SCCs, toposort and transitive dependencies
-    scc_list = graph.scc()
-    graph.transitive_closure()
+    with profile.span('Graph.scc'):
+        scc_list = graph.scc()
+    with profile.span('Graph.transitive_closure'):
+        graph.transitive_closure()
     multi_node_sccs = OrderedDict()
     flat_list = []
     data_toposorted = OrderedDict()
@@ -193,11 +324,35 @@ def process_all(input_dir, intermediate_dir, output_dir, config):
             if uci in data:
                 print(uci, file=fp)
                 data_toposorted[uci] = data[uci]
+
+    # dependencies implied by other dependencies
+    with profile.span('Graph.get_redundant_edges'):
+        redundant_deps = get_redundant_deps(graph)
+    with open(pjoin(intermediate_dir, 'redundant_deps.json'), 'w') as fp:
+        json.dump(redundant_deps, fp, indent=4)
+
+    # lay out the graph in the background while the rest of the pipeline runs
+    redundant_edges = {(uci2, uci) for uci, deps in redundant_deps.items() for uci2 in deps}
+    with profile.span('start_layouts'):
+        layouts = start_layouts(intermediate_dir, config, manifest, data, graph, jobs,
+            redundant_edges)
     data = data_toposorted
 
     # Make JsonProcessor as per config and data
     processor = JsonProcessor(intermediate_dir, config, data, graph)
 
+    # find nodes whose render context changed, and nodes whose page shows data of changed nodes
+    context_hashes = OrderedDict()
+    context_ucis = set(changed_ucis)
+    for uci, d in data.items():
+        context_hashes[uci] = processor.get_structure_hash(d, uci)
+        if context_hashes[uci] != manifest.old_context_hashes.get(uci):
+            context_ucis.add(uci)
+    manifest.context_hashes = context_hashes
+    context_ucis.intersection_update(data.keys())
+    render_ucis = processor.get_affected_ucis(changed_ucis) | context_ucis
+    render_ucis.intersection_update(data.keys())
+
     # create search index, hierarchical index and render context
     search_objs = []
     index_tree = OrderedDict()
@@ -206,16 +361,21 @@ def process_all(input_dir, intermediate_dir, output_dir, config):
         add_to_index_tree(index_tree, uci, processor.get_url(uci), d['metadata'], graph,
             d['status'], d['deps_status'])
         # Write render-context
-        fpath2 = pjoin(intermediate_dir, 'json2', uci[1:] + '.json')
-        context = processor.get_context(d, uci, config.get("FIND_TDEPS", True))
-        write_json_obj(context, fpath2, indent=4)
+        if uci in context_ucis:
+            with profile.span('write context', uci=uci):
+                context = processor.get_context(d, uci, config.get("FIND_TDEPS", True))
+                store.put('json2', uci, context)
 
-    write_json_obj(index_tree, pjoin(intermediate_dir, 'index.json'), indent=4)
+    store.put('meta', 'index', index_tree)
+    store.put('meta', 'nodes', processor.get_node_table())
     search_fields = config.get('SEARCH_FIELDS')
-    search_fields = search_fields if search_fields is not None else ['search']
-    search_fpath = pjoin(output_dir, 'searchinfo', 'raw.json')
-    write_json_obj({'fields': search_fields, 'corpus': search_objs},
-        search_fpath, indent=0)
+    search_fields = search_fields if search_fields is not None else [search.ALL_METADATA_FIELD]
+    outputs.write_json('searchinfo/raw.json', {'fields': search_fields, 'corpus': search_objs},
+        indent=0)
+    with profile.span('search.write_index'):
+        search.write_index(outputs, search_objs, search_fields,
+            config.get('SEARCH_SHARD_PREFIX_LEN', search.DEFAULT_PREFIX_LEN))
+    return (render_ucis, layouts)
 
 
 def main():
@@ -0,0 +1,172 @@
+"""
+Profiling of builds (main.py --profile).
+
+While profiling is enabled (between start() and stop()), span() records how long a block
+of code takes, count() increments counters (files and bytes read and written, cache hits),
+and start_stage() splits the build into stages, for each of which the counters and,
+if memory is traced with tracemalloc, the peak memory usage are recorded.
+Spans of a node's work have a 'uci' argument, which is used to find the slowest nodes.
+The spans can be written as a Chrome trace-event JSON file,
+which can be viewed in chrome://tracing or https://ui.perfetto.dev.
+
+When profiling is disabled, span() returns a shared no-op context manager and
+count() returns immediately, so instrumentation only costs a function call.
+Only the main process is profiled. Work done by worker processes (--jobs > 1)
+only shows up in the spans of the main process that wait for it.
+"""
+
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import Counter, OrderedDict
+from contextlib import nullcontext
+
+NULL_SPAN = nullcontext()
+profiler = None
+
+
+class Span:
+
+    __slots__ = ('profiler', 'name', 'args', 'start_time')
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add_span(self.name, self.start_time, time.perf_counter(), self.args)
+
+
+class Profiler:
+
+    def __init__(self, trace_memory=False):
+        self.start_time = time.perf_counter()
+        self.pid = os.getpid()
+        # (name, start_time, end_time, thread id, args) tuples, which are smaller than dicts
+        self.spans = []
+        self.counters = Counter()
+        self.stages = OrderedDict()
+        self.stage = None
+        self.trace_memory = trace_memory
+        if trace_memory:
+            tracemalloc.start()
+
+    def add_span(self, name, start_time, end_time, args=None):
+        self.spans.append((name, start_time, end_time, threading.get_ident(), args or None))
+
+    def start_stage(self, name):
+        """End the current stage, if any, and start stage name, unless name is None."""
+        now = time.perf_counter()
+        if self.stage is not None:
+            stage_name, start_time, old_counters = self.stage
+            stats = OrderedDict([('duration', now - start_time),
+                ('counters', OrderedDict(sorted((self.counters - old_counters).items())))])
+            if self.trace_memory:
+                stats['peak_memory_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+            self.stages[stage_name] = stats
+            args = OrderedDict(stats['counters'])
+            if 'peak_memory_mb' in stats:
+                args['peak_memory_mb'] = round(stats['peak_memory_mb'], 3)
+            self.add_span(stage_name, start_time, now, args)
+        self.stage = None
+        if name is not None:
+            if self.trace_memory:
+                tracemalloc.reset_peak()
+            self.stage = (name, now, self.counters.copy())
+
+    def stop(self):
+        self.start_stage(None)
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    def get_trace_events(self):
+        yield OrderedDict([('name', 'process_name'), ('ph', 'M'), ('pid', self.pid),
+            ('args', {'name': 'concepdag'})])
+        for name, start_time, end_time, tid, args in self.spans:
+            event = OrderedDict([('name', name), ('ph', 'X'), ('pid', self.pid), ('tid', tid),
+                ('ts', round((start_time - self.start_time) * 1e6, 3)),
+                ('dur', round((end_time - start_time) * 1e6, 3))])
+            if args is not None:
+                event['args'] = args
+            yield event
+
+    def write_trace(self, fpath):
+        # written one event at a time, since there are a few events for every node
+        with open(fpath, 'w') as fp:
+            fp.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+            for i, event in enumerate(self.get_trace_events()):
+                if i:
+                    fp.write(',\n')
+                fp.write(json.dumps(event))
+            fp.write('\n]}\n')
+
+    def get_slowest_nodes(self, n):
+        """Returns the n nodes with the most time in spans with a 'uci' argument."""
+        node_times = {}
+        for name, start_time, end_time, tid, args in self.spans:
+            if args is not None and 'uci' in args:
+                times = node_times.setdefault(args['uci'], Counter())
+                times[name] += end_time - start_time
+        return sorted(node_times.items(), key=lambda item: sum(item[1].values()),
+            reverse=True)[:n]
+
+    def get_summary(self, top_n=10):
+        lines = ['{:<12} {:>10} {:>10}  {}'.format('stage', 'seconds', 'peak_mb', 'counters')]
+        for name, stats in self.stages.items():
+            peak_memory = stats.get('peak_memory_mb')
+            lines.append('{:<12} {:>10.4f} {:>10}  {}'.format(name, stats['duration'],
+                '-' if peak_memory is None else '{:.1f}'.format(peak_memory),
+                ', '.join(['{}={}'.format(k, v) for k, v in stats['counters'].items()])))
+        slowest_nodes = self.get_slowest_nodes(top_n)
+        if slowest_nodes:
+            lines.append('')
+            lines.append('slowest nodes:')
+            for uci, times in slowest_nodes:
+                lines.append('{:>10.4f}  {}  ({})'.format(sum(times.values()), uci,
+                    ', '.join(['{} {:.4f}'.format(name, t) for name, t in times.items()])))
+        return '\n'.join(lines)
+
+
+def start(trace_memory=False):
+    global profiler
+    profiler = Profiler(trace_memory)
+    return profiler
+
+
+def stop():
+    """Stop profiling and return the profiler, or None if profiling wasn't enabled."""
+    global profiler
+    result = profiler
+    profiler = None
+    if result is not None:
+        result.stop()
+    return result
+
+
+def span(name, **args):
+    if profiler is None:
+        return NULL_SPAN
+    return Span(profiler, name, args)
+
+
+def add_span(name, start_time, end_time, **args):
+    # for work which was timed (with time.perf_counter) without a span, like background processes
+    if profiler is not None:
+        profiler.add_span(name, start_time, end_time, args)
+
+
+def count(name, n=1):
+    if profiler is not None:
+        profiler.counters[name] += n
+
+
+def start_stage(name):
+    if profiler is not None:
+        profiler.start_stage(name)
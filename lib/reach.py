@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+
+"""
+Point queries on the dependency graph, like whether a node depends on another,
+the shortest chain of dependencies between two nodes, or what has to be learnt
+(in topological order) before a node, without computing the transitive closure.
+
+Edges of the graph go from a dependency to its dependent, as in process.build_graph.
+
+ReachabilityIndex works on the condensation of the graph (the DAG of SCCs),
+whose SCCs are numbered in topological order by Graph.scc.
+Each SCC gets interval labels from a few depth-first traversals of the condensation
+(like GRAIL): post is the SCC's rank in post-order and low is the smallest post of any
+SCC reachable from it. If b is reachable from a, then every interval of b is
+contained in the corresponding interval of a, b isn't before a in topological order,
+and b is further from the sources and closer to the sinks of the condensation than a.
+A few SCCs with many edges are chosen as landmarks, and each SCC records as bitsets
+which landmarks it can reach and which can reach it. Landmarks which can reach a
+must be able to reach b too, and so on.
+b is certainly reachable from a if a can reach a landmark which can reach b,
+or if b is a descendant of a in a traversal's DFS tree.
+If the labels don't settle a query, a depth-first search does,
+which only enters SCCs whose labels allow them to reach the target.
+
+get_chain is an A* search, whose lower bounds on the length of a chain come from
+the distances in the condensation from and to a few landmarks (like the ALT algorithm).
+These distances are computed by the first call to get_chain.
+"""
+
+import argparse
+from array import array
+from heapq import heappush, heappop
+import random
+import sys
+
+from .graph import Graph, CSRAdjacency
+from .process import build_graph
+from . import store
+
+N_TRAVERSALS = 2
+N_LANDMARKS = 64
+N_DISTANCE_LANDMARKS = 8
+
+
+class ReachabilityIndex:
+
+    def __init__(self, graph, n_traversals=N_TRAVERSALS, n_landmarks=N_LANDMARKS,
+            n_distance_landmarks=N_DISTANCE_LANDMARKS):
+        if graph.topo_order is None:
+            graph.scc()
+        self.graph = graph
+        self.n_distance_landmarks = n_distance_landmarks
+        # computed by the first get_chain, see _get_chain_bounds
+        self.landmark_distances = None
+        cc = graph.topo_order
+        k = len(graph.cclist)
+        cadj = [sorted({cc[v] for u in vlist for v in graph.adj[u]} - {cci})
+            for cci, vlist in enumerate(graph.cclist)]
+        cradj = [[] for cci in range(k)]
+        for cci, ccjs in enumerate(cadj):
+            for ccj in ccjs:
+                cradj[ccj].append(cci)
+        self.cadj = CSRAdjacency(cadj, None)
+        self.cradj = CSRAdjacency(cradj, None)
+
+        # length of the longest path from a source to each SCC and from each SCC to a sink
+        self.level = array('i', [0] * k)
+        self.rlevel = array('i', [0] * k)
+        for cci in range(k):
+            for ccj in cradj[cci]:
+                self.level[cci] = max(self.level[cci], self.level[ccj] + 1)
+        for cci in reversed(range(k)):
+            for ccj in cadj[cci]:
+                self.rlevel[cci] = max(self.rlevel[cci], self.rlevel[ccj] + 1)
+
+        # labels[t] is a tuple of arrays (pre, low, post) from the t-th traversal
+        self.labels = [self._label(t) for t in range(n_traversals)]
+
+        # bit i of from_landmarks[cci] (or to_landmarks[cci]) says whether SCC cci
+        # is reachable from (or can reach) the i-th landmark
+        landmarks = sorted(range(k), key=(lambda cci: (len(cadj[cci]) + 1)
+            * (len(cradj[cci]) + 1)), reverse=True)[:n_landmarks]
+        self.landmarks = landmarks
+        landmark_bits = [0] * k
+        for i, cci in enumerate(landmarks):
+            landmark_bits[cci] = 1 << i
+        self.from_landmarks = list(landmark_bits)
+        for cci in range(k):
+            for ccj in cradj[cci]:
+                self.from_landmarks[cci] |= self.from_landmarks[ccj]
+        self.to_landmarks = landmark_bits
+        for cci in reversed(range(k)):
+            for ccj in cadj[cci]:
+                self.to_landmarks[cci] |= self.to_landmarks[ccj]
+
+    def _label(self, t):
+        # traversal t starts from the SCCs in topological order if t is even, else in reverse,
+        # and visits successors in an order shuffled by a seed t
+        k = len(self.cadj)
+        rng = random.Random(t)
+        reverse = t % 2 == 1
+        low = array('i', [0] * k)
+        post = array('i', [0] * k)
+        pre = array('i', [0] * k)
+        visited = [False] * k
+        pre_rank, post_rank = 0, 0
+        roots = reversed(range(k)) if reverse else range(k)
+        for r in roots:
+            if visited[r]:
+                continue
+            visited[r] = True
+            pre[r] = pre_rank
+            pre_rank += 1
+            stack = [(r, self._iter_shuffled(r, rng))]
+            while stack:
+                u, it = stack[-1]
+                for v in it:
+                    if not visited[v]:
+                        visited[v] = True
+                        pre[v] = pre_rank
+                        pre_rank += 1
+                        stack.append((v, self._iter_shuffled(v, rng)))
+                        break
+                else:
+                    stack.pop()
+                    # in a DAG, all of u's successors are finished before u
+                    post[u] = post_rank
+                    low[u] = min([post_rank] + [low[v] for v in self.cadj[u]])
+                    post_rank += 1
+        return (pre, low, post)
+
+    def _iter_shuffled(self, u, rng):
+        nbrs = list(self.cadj[u])
+        rng.shuffle(nbrs)
+        return iter(nbrs)
+
+    def _may_reach(self, a, b):
+        # False if SCC b is certainly not reachable from SCC a
+        if a > b or self.level[a] >= self.level[b] or self.rlevel[a] <= self.rlevel[b]:
+            return a == b
+        # landmarks which reach a must reach b, and those reachable from b must be from a
+        if (self.from_landmarks[a] & ~self.from_landmarks[b]
+                or self.to_landmarks[b] & ~self.to_landmarks[a]):
+            return False
+        for pre, low, post in self.labels:
+            if low[b] < low[a] or post[b] > post[a]:
+                return False
+        return True
+
+    def _surely_reaches(self, a, b):
+        # True if a reaches b through a landmark or b is a descendant of a in a DFS tree
+        if self.to_landmarks[a] & self.from_landmarks[b]:
+            return True
+        for pre, low, post in self.labels:
+            if pre[a] <= pre[b] and post[b] <= post[a]:
+                return True
+        return False
+
+    def _reaches(self, a, b):
+        if a == b or self._surely_reaches(a, b):
+            return True
+        if not self._may_reach(a, b):
+            return False
+        visited = {a}
+        stack = [a]
+        while stack:
+            u = stack.pop()
+            for v in self.cadj[u]:
+                if v not in visited and self._may_reach(v, b):
+                    if self._surely_reaches(v, b):
+                        return True
+                    visited.add(v)
+                    stack.append(v)
+        return False
+
+    def _get_index(self, label):
+        try:
+            return self.graph.label_to_index[label]
+        except KeyError as e:
+            raise Graph.VertexNotFound(e.args[0])
+
+    def _get_cci(self, label):
+        return self.graph.topo_order[self._get_index(label)]
+
+    def depends_on(self, uci, uci2):
+        """Whether uci is uci2 or depends on uci2, directly or indirectly."""
+        return self._reaches(self._get_cci(uci2), self._get_cci(uci))
+
+    def _get_distances(self, source, adj):
+        # length of the shortest path in the condensation from source to each SCC
+        # along adj, or -1 if there is none
+        dist = array('i', [-1]) * len(adj)
+        dist[source] = 0
+        frontier = [source]
+        d = 0
+        while frontier:
+            d += 1
+            next_frontier = []
+            for u in frontier:
+                for v in adj[u]:
+                    if dist[v] == -1:
+                        dist[v] = d
+                        next_frontier.append(v)
+            frontier = next_frontier
+        return dist
+
+    def _get_chain_bounds(self, target):
+        """
+        Returns a function which gives a lower bound on the length of a chain from
+        an SCC to the SCC target, from the distances of SCCs from and to a few landmarks
+        and the triangle inequality (like the ALT algorithm).
+        """
+        if self.landmark_distances is None:
+            self.landmark_distances = [(self._get_distances(cci, self.cadj),
+                self._get_distances(cci, self.cradj))
+                for cci in self.landmarks[:self.n_distance_landmarks]]
+        bounds = [(dist_from, dist_from[target], dist_to, dist_to[target])
+            for dist_from, dist_to in self.landmark_distances]
+
+        def get_bound(cci):
+            bound = 0
+            for dist_from, target_from, dist_to, target_to in bounds:
+                # d(l, target) <= d(l, cci) + d(cci, target)
+                if target_from != -1 and dist_from[cci] != -1:
+                    bound = max(bound, target_from - dist_from[cci])
+                # d(cci, l) <= d(cci, target) + d(target, l)
+                if target_to != -1 and dist_to[cci] != -1:
+                    bound = max(bound, dist_to[cci] - target_to)
+            return bound
+        return get_bound
+
+    def get_chain(self, uci, uci2):
+        """
+        A shortest chain of dependencies [uci2, ..., uci], where each node is a dependency
+        of the next one. Returns None if uci doesn't depend on uci2.
+        """
+        source, target = self._get_index(uci2), self._get_index(uci)
+        if not self.depends_on(uci, uci2):
+            return None
+        # A* search, which prefers longer chains among those which may be equally short
+        # overall, so that it goes straight to target when the bounds are tight
+        cc = self.graph.topo_order
+        target_cci = cc[target]
+        get_bound = self._get_chain_bounds(target_cci)
+        parent = {source: None}
+        dist = {source: 0}
+        heap = [(get_bound(cc[source]), 0, source)]
+        while heap:
+            f, neg_d, u = heappop(heap)
+            if u == target:
+                break
+            if -neg_d != dist[u]:
+                continue
+            d = dist[u] + 1
+            for v in self.graph.adj[u]:
+                if d < dist.get(v, d + 1) and self._may_reach(cc[v], target_cci):
+                    dist[v] = d
+                    parent[v] = u
+                    heappush(heap, (d + get_bound(cc[v]), -d, v))
+        chain = []
+        u = target
+        while u is not None:
+            chain.append(self.graph.index_to_label[u])
+            u = parent[u]
+        chain.reverse()
+        return chain
+
+    def _get_ancestor_ccs(self, ccis, excluded=()):
+        # SCCs from which some SCC in ccis is reachable, not entering SCCs in excluded
+        result = set(ccis) - set(excluded)
+        stack = list(result)
+        while stack:
+            u = stack.pop()
+            for v in self.cradj[u]:
+                if v not in result and v not in excluded:
+                    result.add(v)
+                    stack.append(v)
+        return result
+
+    def get_learning_path(self, uci, known=()):
+        """
+        uci and its direct and indirect dependencies in topological order,
+        except the nodes in known and their dependencies, which the reader already knows.
+        """
+        known_ccs = self._get_ancestor_ccs([self._get_cci(uci2) for uci2 in known])
+        ccs = self._get_ancestor_ccs([self._get_cci(uci)], known_ccs)
+        labels = self.graph.index_to_label
+        return [labels[u] for cci in sorted(ccs) for u in self.graph.cclist[cci]]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Query the dependency graph of a build from its intermediate records.')
+    parser.add_argument('intermediate_dir')
+    parser.add_argument('--store', choices=['dir', 'sqlite'], default='dir')
+    subparsers = parser.add_subparsers(dest='query', required=True)
+    depends_parser = subparsers.add_parser('depends', help='Whether UCI depends on UCI2')
+    depends_parser.add_argument('uci')
+    depends_parser.add_argument('uci2')
+    chain_parser = subparsers.add_parser('chain',
+        help='Shortest chain of dependencies from UCI2 to UCI')
+    chain_parser.add_argument('uci')
+    chain_parser.add_argument('uci2')
+    path_parser = subparsers.add_parser('path', help='What to learn before UCI, in order')
+    path_parser.add_argument('uci')
+    path_parser.add_argument('--known', nargs='*', default=[],
+        help='Nodes which the reader already knows')
+    args = parser.parse_args()
+
+    records = store.open_store(args.store, args.intermediate_dir, False)
+    try:
+        data, graph, broken_deps = build_graph(records)
+    finally:
+        records.close()
+    index = ReachabilityIndex(graph)
+    try:
+        if args.query == 'depends':
+            print(index.depends_on(args.uci, args.uci2))
+        elif args.query == 'chain':
+            chain = index.get_chain(args.uci, args.uci2)
+            print('\n'.join(chain) if chain is not None else 'no chain')
+        else:
+            print('\n'.join(index.get_learning_path(args.uci, args.known)))
+    except Graph.VertexNotFound as e:
+        sys.exit('node not found: {}'.format(e))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,99 @@
 #!/usr/bin/env python3
 
+import argparse
+import json
+import os
 from os.path import join as pjoin
 import shutil
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from jinja2 import (
+    Environment, FileSystemLoader, ModuleLoader, FileSystemBytecodeCache, select_autoescape,
+    )
 from .common import (
-    read_json_obj, write_string_to_file, get_uci_fpath_list,
-    get_relative_site_url_from_uci,
+    write_string_to_file, get_relative_site_url_from_uci, get_node_relpath,
+    get_node_fragment_relpath, hash_dir,
+    hash_string, batched, imap_bounded,
     )
+from . import profile
+from .layout import GRAPH_LAYOUT_KEY
+
+RENDER_BATCH_SIZE = 64
+SITE_PAGES = ('index.html', 'search.html', 'about.html')
+# dependency lists which can be truncated to config['DEPLIST_CAP'] items
+FRAGMENT_DEPLISTS = ('rdeps', 'tdeps')
+worker_state = None
+# the jinja environment of the last build by the arguments of get_jinja_env,
+# kept across builds in watch mode
+jinja_envs = {}
 
 
-def get_jinja_env(templates_dir):
+def get_jinja_env(templates_dir, bytecode_cache_dir=None, compiled_dir=None):
+    """
+    If compiled_dir is given, load templates precompiled by main() from there.
+    Otherwise, if bytecode_cache_dir is given, cache compiled templates there.
+    """
+    if compiled_dir is not None:
+        loader = ModuleLoader(compiled_dir)
+    else:
+        loader = FileSystemLoader(templates_dir)
+    if bytecode_cache_dir is not None:
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+    else:
+        bytecode_cache = None
     return Environment(
-        loader=FileSystemLoader(templates_dir),
+        loader=loader,
+        bytecode_cache=bytecode_cache,
         autoescape=select_autoescape([]),
         trim_blocks=True,
         lstrip_blocks=True,
     )
 
 
-def get_context(config, pages_dir=None, d=None, uci=None):
+def get_cached_jinja_env(*env_args):
+    jinja_env = jinja_envs.get(env_args)
+    if jinja_env is None:
+        # the arguments include the theme's hash, so older environments won't be used again
+        jinja_envs.clear()
+        jinja_env = get_jinja_env(*env_args)
+        jinja_envs[env_args] = jinja_env
+    return jinja_env
+
+
+def get_bytecode_cache_dir(intermediate_dir, theme_hash):
+    # one subdirectory per theme version, and remove those of other versions
+    cache_root = pjoin(intermediate_dir, 'jinja_cache')
+    try:
+        for name in os.listdir(cache_root):
+            if name != theme_hash:
+                shutil.rmtree(pjoin(cache_root, name))
+    except FileNotFoundError:
+        pass
+    return pjoin(cache_root, theme_hash)
+
+
+def resolve_deplist(deplist, nodes):
+    """
+    Convert [uci, reason] references to dependencies into
+    the objects that templates expect, using the node table nodes.
+    """
+    result = []
+    for uci, reason in deplist:
+        node = nodes.get(uci)
+        result.append(OrderedDict([
+            ('uci', uci),
+            ('exists', node is not None),
+            ('reason', reason),
+            ('status', None if node is None else node['status']),
+            ('deps_status', None if node is None else node['deps_status']),
+            ('metadata', None if node is None else node['metadata']),
+        ]))
+    return result
+
+
+def get_context(config, d=None, uci=None, document=None, nodes=None):
     context = config.copy()
     if config.get('SITEURL') is None:
         if uci is None:
@@ -30,52 +104,176 @@ def get_context(config, pages_dir=None, d=None, uci=None):
     if d is not None:
         for k, v in d.items():
             context[k] = v
-        if uci is not None and pages_dir is not None:
-            doc_path = pjoin(pages_dir, uci[1:] + '.html')
-            try:
-                with open(doc_path) as fp:
-                    context['document'] = fp.read()
-            except FileNotFoundError:
-                context['document'] = None
+        context['deps'] = [resolve_deplist(deplist, nodes) for deplist in d['deps']]
+        context['rdeps'] = resolve_deplist(d['rdeps'], nodes)
+        context['tdeps'] = resolve_deplist(((uci2, None) for uci2 in d['tdeps']), nodes)
+        context['document'] = document
     context['uci'] = uci
     return context
 
 
-def render_all(theme_dir, input_dir, intermediate_dir, output_dir, config,
-        some_json_changed, modified_ucis):
-    jinja_env = get_jinja_env(pjoin(theme_dir, 'templates'))
+def get_fragment_dep(dep, reason_map):
+    # a compact form of dep, which theme/static/deplist_more.js shows like print_deplist
+    obj = OrderedDict([('uci', dep['uci'])])
+    if dep['exists']:
+        if dep['metadata'].get('title'):
+            obj['title'] = dep['metadata']['title']
+        if dep['status'] != 'ok':
+            obj['status'] = dep['status']
+    else:
+        obj['missing'] = True
+    if reason_map and dep['reason']:
+        obj['reason'] = reason_map.get(dep['reason'], dep['reason'])
+    return obj
+
+
+def split_deplists(context, cap):
+    """
+    Truncate the rdeps and tdeps lists in context to cap items each,
+    and set rdeps_more and tdeps_more to the number of items left out.
+    Returns the fragment, which has the items left out, or None if nothing was left out.
+    """
+    if cap is None:
+        return None
+    fragment = OrderedDict()
+    for key in FRAGMENT_DEPLISTS:
+        deplist = context[key]
+        if len(deplist) > cap:
+            reason_map = context.get('DEP_REASON_MAP')
+            fragment[key] = [get_fragment_dep(dep, reason_map) for dep in deplist[cap:]]
+            context[key] = deplist[:cap]
+            context[key + '_more'] = len(deplist) - cap
+    return fragment or None
+
+
+def render_page(template, config, nodes, uci, d, document):
+    """Returns the rendered page and its fragment (see split_deplists)."""
+    context = get_context(config, d, uci, document, nodes)
+    fragment = split_deplists(context, config.get('DEPLIST_CAP'))
+    return (template.render(**context), fragment)
+
+
+def render_site_page(template, config, index_tree):
+    context = get_context(config)
+    context['index_tree'] = index_tree
+    return template.render(**context)
+
+
+def render_node(template, config, nodes, output_dir, uci, d, document):
+    """
+    Returns the paths relative to output_dir and the hashes of the node's output files,
+    as a list of (relpath, digest) pairs. digest is None for a file which the node doesn't have.
+    """
+    with profile.span('render node', uci=uci):
+        rendered, fragment = render_page(template, config, nodes, uci, d, document)
+    with profile.span('write node', uci=uci):
+        relpath = get_node_relpath(uci)
+        write_string_to_file(rendered, pjoin(output_dir, *relpath.split('/')))
+        fragment_relpath = get_node_fragment_relpath(uci)
+        if fragment is None:
+            fragment_digest = None
+        else:
+            fragment_str = json.dumps(fragment, separators=(',', ':'))
+            write_string_to_file(fragment_str, pjoin(output_dir, *fragment_relpath.split('/')))
+            fragment_digest = hash_string(fragment_str)
+    return [(relpath, hash_string(rendered)), (fragment_relpath, fragment_digest)]
+
+
+def init_worker(env_args, config, nodes, output_dir):
+    # every worker process loads its own jinja environment and node table once
+    global worker_state
+    template = get_jinja_env(*env_args).get_template('node.html')
+    worker_state = (template, config, nodes, output_dir)
+
+
+def render_node_batch(batch):
+    template, config, nodes, output_dir = worker_state
+    results = []
+    for uci, d, document in batch:
+        results += render_node(template, config, nodes, output_dir, uci, d, document)
+    return results
+
+
+def record_outputs(outputs, results):
+    for relpath, digest in results:
+        if digest is None:
+            outputs.remove(relpath)
+        else:
+            outputs.record(relpath, digest)
+
+
+def render_all(theme_dir, input_dir, intermediate_dir, outputs, store, config, manifest,
+        modified_ucis, jobs=1, compiled_dir=None, index_changed=True, layouts=None):
+    """
+    Render the pages of modified_ucis (or of all nodes if the theme changed).
+    The index, search and about pages are only rendered if index_changed or the theme changed.
+    layouts (from process.process_all, if the graph was processed) are joined
+    before graph layouts are copied.
+    """
+    output_dir = outputs.output_dir
+    templates_dir = pjoin(theme_dir, 'templates')
+    theme_hash = hash_dir(templates_dir)
+    theme_changed = manifest.is_modified('theme', theme_hash)
+    env_args = (templates_dir, get_bytecode_cache_dir(intermediate_dir, theme_hash), compiled_dir)
+    jinja_env = get_cached_jinja_env(*env_args)
 
     # render nodes
-    uci_fpath_list = get_uci_fpath_list(pjoin(intermediate_dir, 'json2'))
-    pages_dir = pjoin(intermediate_dir, 'pages')
-    template = jinja_env.get_template('node.html')
-    for uci, fpath in uci_fpath_list:
-        if some_json_changed or uci in modified_ucis:
-            d = read_json_obj(fpath)
-            context = get_context(config, pages_dir, d, uci)
-            rendered = template.render(**context)
-            output_fpath = pjoin(output_dir, 'nodes', uci[1:] + '.html')
-            write_string_to_file(rendered, output_fpath)
+    if theme_changed:
+        items = store.items('json2')
+    else:
+        items = ((uci, store.get('json2', uci)) for uci in store.keys('json2')
+            if uci in modified_ucis)
+    node_args = ((uci, d, store.get('pages', uci)) for uci, d in items)
+    nodes = store.get('meta', 'nodes')
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                initargs=(env_args, config, nodes, output_dir)) as executor:
+            # bound the number of batches in flight so that memory usage stays flat
+            for results in imap_bounded(executor, render_node_batch,
+                    batched(node_args, RENDER_BATCH_SIZE), 2 * jobs):
+                record_outputs(outputs, results)
+    else:
+        template = jinja_env.get_template('node.html')
+        for uci, d, document in node_args:
+            record_outputs(outputs,
+                render_node(template, config, nodes, output_dir, uci, d, document))
 
     # render index and search
-    context = get_context(config)
-    index_tree_path = pjoin(intermediate_dir, 'index.json')
-    context['index_tree'] = read_json_obj(index_tree_path)
-    for fname in ('index.html', 'search.html', 'about.html'):
-        template = jinja_env.get_template(fname)
-        s = template.render(**context)
-        output_fpath = pjoin(output_dir, fname)
-        write_string_to_file(s, output_fpath)
+    if index_changed or theme_changed:
+        index_tree = store.get('meta', 'index')
+        for fname in SITE_PAGES:
+            with profile.span('render site page', page=fname):
+                outputs.write_string(fname,
+                    render_site_page(jinja_env.get_template(fname), config, index_tree))
 
     # copy static assets
-    if 'dot' not in config['DISABLE']:
-        shutil.copyfile(pjoin(intermediate_dir, 'graph.svg'), pjoin(output_dir, 'graph.svg'))
+    if layouts is not None:
+        with profile.span('join layouts'):
+            layouts.join(outputs)
+    else:
+        manifest.keep(GRAPH_LAYOUT_KEY)
+    svg_fpath = pjoin(intermediate_dir, 'graph.svg')
+    if 'dot' not in config['DISABLE'] and os.path.exists(svg_fpath):
+        outputs.copy_file(svg_fpath, 'graph.svg')
+    elif 'graph.svg' in outputs.hashes:
+        # dot was disabled or the layout failed
+        outputs.remove('graph.svg')
 
     # copy theme
-    input_dirpath = pjoin(theme_dir, 'static')
-    output_dirpath = pjoin(output_dir, 'theme')
-    try:
-        shutil.rmtree(output_dirpath)
-    except FileNotFoundError:
-        pass
-    shutil.copytree(input_dirpath, output_dirpath)
+    with profile.span('copy theme'):
+        outputs.sync_dir(pjoin(theme_dir, 'static'), 'theme')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precompile a theme's templates into python modules.")
+    parser.add_argument('theme_dir')
+    parser.add_argument('output_dir', help='Directory to write compiled templates to')
+    args = parser.parse_args()
+
+    jinja_env = get_jinja_env(pjoin(args.theme_dir, 'templates'))
+    jinja_env.compile_templates(args.output_dir, zip=None, ignore_errors=False)
+
+
+if __name__ == '__main__':
+    main()
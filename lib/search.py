@@ -0,0 +1,98 @@
+"""
+Build a sharded inverted index for searching nodes, which theme/static/search.js queries.
+
+The values of SEARCH_FIELDS are split into lowercase tokens.
+The index maps each token to the sorted list of ids of the documents containing it,
+and tokens are sharded by their first prefix_len characters, so that a search
+only fetches the shards which its query tokens start with.
+A document's id is its position in the document table, which only has the fields
+needed to show search results (see get_doc_fields).
+A query matches the documents which have, for every token of the query,
+a token starting with it.
+
+Files written to searchinfo/index in output_dir:
+* meta.json: prefix_len, doc_fields and the list of shard keys.
+* docs.json: the document table, a list of lists of values of doc_fields.
+* shards/<hex>.json: a shard, mapping tokens to document ids.
+  <hex> is the hex encoding of the shard key's UTF-8 bytes.
+"""
+
+import json
+import re
+from collections import OrderedDict
+
+TOKEN_RE = re.compile(r'\w+')
+DEFAULT_PREFIX_LEN = 2
+# field which process_all makes out of all metadata if SEARCH_FIELDS isn't set
+ALL_METADATA_FIELD = 'search'
+INDEX_DIR = 'searchinfo/index'
+COMPACT_SEPARATORS = (',', ':')
+
+
+def tokenize(s):
+    return TOKEN_RE.findall(s.lower())
+
+
+def get_field_strings(value):
+    if value is None:
+        return []
+    elif isinstance(value, list):
+        return [x for x in value if isinstance(x, str)]
+    else:
+        return [str(value)]
+
+
+def get_shard_relpath(key):
+    return '{}/shards/{}.json'.format(INDEX_DIR, key.encode('utf-8').hex())
+
+
+def get_doc_fields(search_fields):
+    """
+    Fields of the document table: uci, which results link to, and search_fields,
+    where the field made of all metadata is replaced by title and description.
+    """
+    doc_fields = ['uci']
+    for field in search_fields:
+        fields = ['title', 'description'] if field == ALL_METADATA_FIELD else [field]
+        doc_fields.extend(field2 for field2 in fields if field2 not in doc_fields)
+    return doc_fields
+
+
+def build_index(search_objs, search_fields, doc_fields, prefix_len):
+    """Returns the document table and a dict mapping shard keys to shards."""
+    docs = []
+    postings = {}
+    for doc_id, obj in enumerate(search_objs):
+        docs.append([obj.get(field) for field in doc_fields])
+        tokens = set()
+        for field in search_fields:
+            for s in get_field_strings(obj.get(field)):
+                tokens.update(tokenize(s))
+        for token in tokens:
+            postings.setdefault(token, []).append(doc_id)
+    shards = OrderedDict()
+    for token in sorted(postings):
+        shards.setdefault(token[:prefix_len], OrderedDict())[token] = postings[token]
+    return (docs, shards)
+
+
+def write_index(outputs, search_objs, search_fields, prefix_len=DEFAULT_PREFIX_LEN):
+    doc_fields = get_doc_fields(search_fields)
+    docs, shards = build_index(search_objs, search_fields, doc_fields, prefix_len)
+
+    def write(relpath, obj):
+        outputs.write_string(relpath, json.dumps(obj, separators=COMPACT_SEPARATORS))
+
+    meta = OrderedDict([('prefix_len', prefix_len), ('doc_fields', doc_fields),
+        ('shards', list(shards.keys()))])
+    write(INDEX_DIR + '/meta.json', meta)
+    write(INDEX_DIR + '/docs.json', docs)
+    shard_relpaths = set()
+    for key, shard in shards.items():
+        relpath = get_shard_relpath(key)
+        shard_relpaths.add(relpath)
+        write(relpath, shard)
+    # remove shards whose tokens no longer occur
+    for relpath in [relpath for relpath in outputs.hashes
+            if relpath.startswith(INDEX_DIR + '/shards/') and relpath not in shard_relpaths]:
+        outputs.remove(relpath)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+Development server which renders pages when they are requested.
+
+The input is parsed and processed like in a build (incrementally, if intermediate_dir
+has the records of an earlier build), but pages are only rendered on request
+and are then kept in an LRU cache. The input and the theme are watched for changes,
+and pages whose render context changed are dropped from the cache.
+
+Intermediate records are kept in memory and are never written back to intermediate_dir.
+Other files produced by the pipeline (like the search corpus and the theme's static files)
+are written to a temporary directory, from where all other requests are served.
+"""
+
+import argparse
+import itertools
+import json
+import os
+from os.path import join as pjoin
+import shutil
+import tempfile
+import threading
+import traceback
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from urllib.parse import urlsplit, unquote
+
+from . import parse, process, render, store, watch
+from .cache import MemoryCache
+from .common import (
+    BuildManifest, OutputTracker, get_config, get_node_relpath, get_node_fragment_relpath,
+    get_uci_from_node_relpath, get_uci_from_node_fragment_relpath, hash_dir,
+    )
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_THEME_DIR = pjoin(BASE_DIR, 'theme')
+
+
+class Site:
+
+    def __init__(self, input_dir, intermediate_dir, theme_dir, store_name='dir',
+            cache_size=64 * 2**20, conversion_cache_size=256 * 2**20):
+        self.input_dir = input_dir
+        self.intermediate_dir = intermediate_dir
+        self.theme_dir = theme_dir
+        self.conversion_cache_size = conversion_cache_size
+        self.records = store.open_store(store_name, intermediate_dir, in_memory=True)
+        self.work_dir = tempfile.mkdtemp(prefix='concepdag-serve-')
+        self.output_dir = pjoin(self.work_dir, 'output')
+        os.makedirs(self.output_dir)
+        self.pages = MemoryCache(cache_size)
+        self.lock = threading.Lock()
+        # set once the first update has been attempted
+        self.ready = threading.Event()
+        self.config = None
+        self.theme_hash = None
+        self.jinja_env = None
+
+    def update(self, changed_paths=None):
+        """Parse and process changed input, and drop pages which changed from the cache."""
+        try:
+            with self.lock:
+                self._update(changed_paths)
+        finally:
+            self.ready.set()
+
+    def _update(self, changed_paths):
+        config = get_config(self.input_dir)
+        # graph.svg isn't generated, so the templates shouldn't link to it
+        serve_config = dict(config, DISABLE=config['DISABLE'] + ['dot'])
+        manifest = BuildManifest(self.records, changed_paths)
+        outputs = OutputTracker(self.output_dir, self.records)
+        changed_ucis, modified_ucis = parse.process_all(self.input_dir,
+            self.intermediate_dir, self.records, outputs, config, manifest,
+            cache_size=self.conversion_cache_size)
+        # the first update processes the graph even if nothing changed since the last build,
+        # to produce the files which are written to output_dir
+        context_outdated = process.is_context_outdated(manifest)
+        if changed_ucis or context_outdated or self.config is None:
+            # nothing is laid out, since serve_config disables dot
+            render_ucis, layouts = process.process_all(self.input_dir, self.work_dir,
+                outputs, self.records, serve_config, manifest, changed_ucis)
+            modified_ucis |= render_ucis
+
+        templates_dir = pjoin(self.theme_dir, 'templates')
+        theme_hash = hash_dir(templates_dir)
+        if theme_hash != self.theme_hash or serve_config != self.config:
+            self.pages.clear()
+            self.jinja_env = render.get_jinja_env(templates_dir)
+        else:
+            deleted_ucis = [uci for uci in changed_ucis if self.records.get('json2', uci) is None]
+            for uci in itertools.chain(modified_ucis, deleted_ucis):
+                self.pages.pop(get_node_relpath(uci))
+                self.pages.pop(get_node_fragment_relpath(uci))
+            if changed_ucis:
+                # the index tree changed
+                for fname in render.SITE_PAGES:
+                    self.pages.pop(fname)
+        outputs.sync_dir(pjoin(self.theme_dir, 'static'), 'theme')
+
+        manifest.save(self.records)
+        outputs.save(self.records, self.work_dir)
+        self.config = serve_config
+        self.theme_hash = theme_hash
+        print('updated {} pages'.format(len(modified_ucis)))
+
+    def get_page(self, relpath):
+        """
+        Returns the rendered page (or node fragment) at relpath,
+        or None if relpath isn't a page.
+        """
+        self.ready.wait()
+        with self.lock:
+            if self.config is None:
+                return None
+            page = self.pages.get(relpath)
+            if page is not None:
+                return page
+            if relpath in render.SITE_PAGES:
+                page = render.render_site_page(self.jinja_env.get_template(relpath),
+                    self.config, self.records.get('meta', 'index'))
+                self.pages.put(relpath, page)
+                return page
+            uci = get_uci_from_node_relpath(relpath)
+            if uci is None:
+                uci = get_uci_from_node_fragment_relpath(relpath)
+            d = None if uci is None else self.records.get('json2', uci)
+            if d is None:
+                return None
+            page, fragment = render.render_page(self.jinja_env.get_template('node.html'),
+                self.config, self.records.get('meta', 'nodes'), uci, d,
+                self.records.get('pages', uci))
+            self.pages.put(get_node_relpath(uci), page)
+            if fragment is not None:
+                fragment = json.dumps(fragment, separators=(',', ':'))
+                self.pages.put(get_node_fragment_relpath(uci), fragment)
+            return page if relpath == get_node_relpath(uci) else fragment
+
+    def close(self):
+        self.records.close()
+        shutil.rmtree(self.work_dir)
+
+
+class RequestHandler(SimpleHTTPRequestHandler):
+
+    def __init__(self, *args, site, **kwargs):
+        self.site = site
+        super().__init__(*args, directory=site.output_dir, **kwargs)
+
+    def do_GET(self):
+        relpath = unquote(urlsplit(self.path).path).lstrip('/') or 'index.html'
+        try:
+            page = self.site.get_page(relpath)
+        except Exception:
+            traceback.print_exc()
+            self.send_error(500)
+            return
+        if page is None:
+            super().do_GET()
+            return
+        body = page.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(relpath) + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input_dir')
+    parser.add_argument('intermediate_dir',
+        help='Directory with the intermediate records of an earlier build, if any')
+    parser.add_argument('--theme', default=DEFAULT_THEME_DIR)
+    parser.add_argument('--store', choices=store.STORE_CLASSES.keys(), default='dir')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8000)
+    parser.add_argument('--page-cache-size', type=int, default=64,
+        help='Size bound in MiB of the rendered page cache')
+    parser.add_argument('--conversion-cache-size', type=int, default=256,
+        help='Size bound in MiB of the Markdown conversion cache (0 to disable)')
+    args = parser.parse_args()
+
+    site = Site(args.input_dir, args.intermediate_dir, args.theme, store_name=args.store,
+        cache_size=args.page_cache_size * 2**20,
+        conversion_cache_size=args.conversion_cache_size * 2**20)
+    watcher = watch.get_watcher([args.input_dir, args.theme])
+    thread = threading.Thread(target=watch.rebuild_on_change, args=(watcher, site.update),
+        daemon=True)
+    thread.start()
+    server = ThreadingHTTPServer((args.host, args.port),
+        lambda *args2, **kwargs: RequestHandler(*args2, site=site, **kwargs))
+    print('serving on http://{}:{}/'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        site.close()
+
+
+if __name__ == '__main__':
+    main()
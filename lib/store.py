@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+"""
+Storage for intermediate records, which are passed between the stages of the pipeline.
+
+There are 4 kinds of records:
+* json1: parsed node JSON, keyed by UCI.
+* json2: render context of a node, keyed by UCI.
+  Dependencies are referred to by UCI, and their data is in the 'nodes' meta record.
+* pages: HTML document of a node, keyed by UCI.
+* meta: other JSON objects, like the build manifest, the index tree, the node table
+  and the hashes of output files, keyed by name.
+
+DirStore stores each record as a file in intermediate_dir.
+SqliteStore stores all records in a single SQLite database in intermediate_dir.
+Writes to a SqliteStore are done in a single transaction, which is committed by commit().
+Stores aren't thread-safe, but they can be used by several threads (like in lib.serve)
+if access to them is serialized.
+MemoryStore keeps records in memory, so that stages can pass them to each other
+without serializing them. It can optionally be backed by a DirStore or SqliteStore,
+in which case records are read from it on demand and writes are flushed to it by commit().
+"""
+
+import argparse
+import json
+import os
+from os.path import join as pjoin
+import sqlite3
+from collections import OrderedDict
+
+from . import profile
+from .common import (
+    get_uci_fpath_list, read_json_obj, write_json_obj, write_string_to_file, remove_file,
+    )
+
+UCI_KINDS = ('json1', 'json2', 'pages')
+JSON_KINDS = ('json1', 'json2', 'meta')
+META_KEYS = ('manifest', 'index', 'nodes', 'outputs')
+SQLITE_FNAME = 'intermediate.sqlite3'
+
+
+class DirStore:
+
+    name = 'dir'
+
+    def __init__(self, intermediate_dir, indent=4):
+        self.intermediate_dir = intermediate_dir
+        self.indent = indent
+
+    def get_fpath(self, kind, key):
+        if kind == 'meta':
+            return pjoin(self.intermediate_dir, key + '.json')
+        relpath = key[1:] + ('.html' if kind == 'pages' else '.json')
+        if os.path.sep != '/':
+            relpath = relpath.replace('/', os.path.sep)
+        return pjoin(self.intermediate_dir, kind, relpath)
+
+    def get(self, kind, key):
+        fpath = self.get_fpath(kind, key)
+        try:
+            if kind in JSON_KINDS:
+                return read_json_obj(fpath)
+            else:
+                with open(fpath) as fp:
+                    s = fp.read()
+                profile.count('files_read')
+                profile.count('bytes_read', len(s))
+                return s
+        except FileNotFoundError:
+            return None
+
+    def put(self, kind, key, value):
+        fpath = self.get_fpath(kind, key)
+        if kind == 'meta':
+            # meta records are small and must not be left half-written
+            temp_fpath = fpath + '.tmp'
+            write_json_obj(value, temp_fpath, indent=self.indent)
+            os.replace(temp_fpath, fpath)
+        elif kind in JSON_KINDS:
+            write_json_obj(value, fpath, indent=self.indent)
+        else:
+            write_string_to_file(value, fpath)
+
+    def put_many(self, kind, items):
+        for key, value in items:
+            self.put(kind, key, value)
+
+    def delete(self, kind, key):
+        remove_file(self.get_fpath(kind, key), self.intermediate_dir)
+
+    def keys(self, kind):
+        if kind == 'meta':
+            return [key for key in META_KEYS if os.path.exists(self.get_fpath(kind, key))]
+        else:
+            return [uci for uci, fpath in get_uci_fpath_list(pjoin(self.intermediate_dir, kind),
+                ext='.html' if kind == 'pages' else '.json')]
+
+    def items(self, kind):
+        for key in self.keys(kind):
+            yield (key, self.get(kind, key))
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteStore:
+
+    name = 'sqlite'
+
+    def __init__(self, intermediate_dir):
+        os.makedirs(intermediate_dir, exist_ok=True)
+        self.conn = sqlite3.connect(pjoin(intermediate_dir, SQLITE_FNAME),
+            check_same_thread=False)
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS records (kind TEXT NOT NULL,'
+            ' key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (kind, key)) WITHOUT ROWID')
+        self.conn.commit()
+
+    @staticmethod
+    def encode(kind, value):
+        return json.dumps(value) if kind in JSON_KINDS else value
+
+    @staticmethod
+    def decode(kind, s):
+        return json.loads(s, object_pairs_hook=OrderedDict) if kind in JSON_KINDS else s
+
+    def get(self, kind, key):
+        row = self.conn.execute('SELECT value FROM records WHERE kind = ? AND key = ?',
+            (kind, key)).fetchone()
+        return None if row is None else self.decode(kind, row[0])
+
+    def put(self, kind, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?)',
+            (kind, key, self.encode(kind, value)))
+
+    def put_many(self, kind, items):
+        self.conn.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?)',
+            ((kind, key, self.encode(kind, value)) for key, value in items))
+
+    def delete(self, kind, key):
+        self.conn.execute('DELETE FROM records WHERE kind = ? AND key = ?', (kind, key))
+
+    def keys(self, kind):
+        return [row[0] for row in self.conn.execute(
+            'SELECT key FROM records WHERE kind = ? ORDER BY key', (kind,))]
+
+    def items(self, kind):
+        for key, s in self.conn.execute(
+                'SELECT key, value FROM records WHERE kind = ? ORDER BY key', (kind,)):
+            yield (key, self.decode(kind, s))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class MemoryStore:
+
+    name = 'memory'
+
+    def __init__(self, backing=None):
+        self.backing = backing
+        self.records = {kind: OrderedDict() for kind in UCI_KINDS + ('meta',)}
+        self.dirty = {kind: set() for kind in self.records}
+        self.deleted = {kind: set() for kind in self.records}
+        self.loaded = set()
+
+    def get(self, kind, key):
+        value = self.records[kind].get(key)
+        if (value is None and self.backing is not None and kind not in self.loaded
+                and key not in self.deleted[kind]):
+            value = self.backing.get(kind, key)
+        return value
+
+    def put(self, kind, key, value):
+        self.records[kind][key] = value
+        self.dirty[kind].add(key)
+        self.deleted[kind].discard(key)
+
+    def put_many(self, kind, items):
+        for key, value in items:
+            self.put(kind, key, value)
+
+    def delete(self, kind, key):
+        self.records[kind].pop(key, None)
+        self.dirty[kind].discard(key)
+        self.deleted[kind].add(key)
+
+    def keys(self, kind):
+        if self.backing is None or kind in self.loaded:
+            return list(self.records[kind])
+        # keep the backing store's order, so that results don't depend on what was modified
+        records = self.records[kind]
+        backing_keys = [key for key in self.backing.keys(kind)
+            if key not in self.deleted[kind]]
+        backing_key_set = set(backing_keys)
+        return backing_keys + [key for key in records if key not in backing_key_set]
+
+    def items(self, kind):
+        if self.backing is not None and kind not in self.loaded:
+            records = self.records[kind]
+            records2 = OrderedDict()
+            for key, value in self.backing.items(kind):
+                if key not in self.deleted[kind]:
+                    records2[key] = records.get(key, value)
+            for key, value in records.items():
+                records2.setdefault(key, value)
+            self.records[kind] = records2
+            self.loaded.add(kind)
+        return list(self.records[kind].items())
+
+    def commit(self):
+        if self.backing is not None:
+            for kind, records in self.records.items():
+                for key in self.deleted[kind]:
+                    self.backing.delete(kind, key)
+                self.backing.put_many(kind, [(key, records[key]) for key in self.dirty[kind]])
+                self.dirty[kind].clear()
+                self.deleted[kind].clear()
+            self.backing.commit()
+
+    def close(self):
+        if self.backing is not None:
+            self.backing.close()
+
+
+STORE_CLASSES = {cls.name: cls for cls in (DirStore, SqliteStore, MemoryStore)}
+
+
+def open_store(name, intermediate_dir, in_memory=False):
+    if name == MemoryStore.name:
+        return MemoryStore()
+    store = STORE_CLASSES[name](intermediate_dir)
+    return MemoryStore(store) if in_memory else store
+
+
+def migrate(src, dst):
+    for kind in UCI_KINDS + ('meta',):
+        dst.put_many(kind, src.items(kind))
+    dst.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Copy intermediate records between stores.')
+    parser.add_argument('intermediate_dir')
+    persistent_names = [DirStore.name, SqliteStore.name]
+    parser.add_argument('--from', dest='src', choices=persistent_names, default='dir')
+    parser.add_argument('--to', dest='dst', choices=persistent_names, default='sqlite')
+    args = parser.parse_args()
+    src = open_store(args.src, args.intermediate_dir)
+    dst = open_store(args.dst, args.intermediate_dir)
+    migrate(src, dst)
+    src.close()
+    dst.close()
+
+
+if __name__ == '__main__':
+    main()
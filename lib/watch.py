@@ -0,0 +1,189 @@
+"""
+Watch directory trees for changes to files.
+
+InotifyWatcher uses Linux's inotify (through ctypes).
+PollingWatcher periodically scans the directory trees and compares mtimes and sizes.
+get_watcher returns an InotifyWatcher if inotify is available, else a PollingWatcher.
+
+wait() blocks until some files change and returns the set of their absolute paths,
+or None if the watcher lost track of changes and everything should be considered changed.
+rebuild_on_change runs a build function every time wait() returns.
+"""
+
+import ctypes
+import ctypes.util
+import os
+from os.path import join as pjoin
+import select
+import struct
+import sys
+import time
+import traceback
+
+# debounce: after a change, wait until no more changes happen for this many seconds
+QUIET_PERIOD = 0.05
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def list_files(dirpath):
+    for dirpath2, dirnames, fnames in os.walk(dirpath):
+        for fname in fnames:
+            yield pjoin(dirpath2, fname)
+
+
+class InotifyWatcher:
+
+    class Unavailable(OSError):
+        pass
+
+    def __init__(self, roots):
+        if not sys.platform.startswith('linux'):
+            raise self.Unavailable('inotify is only available on Linux')
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise self.Unavailable('could not find libc')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise self.Unavailable(ctypes.get_errno(), 'inotify_init1 failed')
+        self.wd_to_dir = {}
+        for root in roots:
+            self.add_tree(os.path.abspath(root))
+
+    def add_tree(self, root):
+        for dirpath, dirnames, fnames in os.walk(root):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                raise self.Unavailable(ctypes.get_errno(), 'inotify_add_watch failed', dirpath)
+            self.wd_to_dir[wd] = dirpath
+
+    def read_events(self, changed_paths):
+        # returns False if events were lost
+        buf = os.read(self.fd, 64 * 1024)
+        i = 0
+        while i < len(buf):
+            wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(buf, i)
+            i += EVENT_HEADER.size
+            name = os.fsdecode(buf[i: i + name_len].rstrip(b'\0'))
+            i += name_len
+            if mask & IN_Q_OVERFLOW:
+                return False
+            if mask & IN_IGNORED:
+                self.wd_to_dir.pop(wd, None)
+                continue
+            dirpath = self.wd_to_dir.get(wd)
+            if dirpath is None:
+                continue
+            path = pjoin(dirpath, name) if name else dirpath
+            changed_paths.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # files may have been created before the new directory was watched
+                self.add_tree(path)
+                changed_paths.update(list_files(path))
+        return True
+
+    def wait(self):
+        changed_paths = set()
+        complete = True
+        timeout = None
+        while True:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if not readable:
+                break
+            complete = self.read_events(changed_paths) and complete
+            timeout = QUIET_PERIOD
+        return changed_paths if complete else None
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+
+    def __init__(self, roots, interval=0.5):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for root in self.roots:
+            for fpath in list_files(root):
+                try:
+                    stat = os.stat(fpath)
+                except FileNotFoundError:
+                    continue
+                snapshot[fpath] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def get_changes(self):
+        snapshot = self.scan()
+        changed_paths = {fpath for fpath in snapshot.keys() | self.snapshot.keys()
+            if snapshot.get(fpath) != self.snapshot.get(fpath)}
+        self.snapshot = snapshot
+        return changed_paths
+
+    def wait(self):
+        changed_paths = set()
+        while not changed_paths:
+            time.sleep(self.interval)
+            changed_paths = self.get_changes()
+        while True:
+            time.sleep(QUIET_PERIOD)
+            changed_paths2 = self.get_changes()
+            if not changed_paths2:
+                return changed_paths
+            changed_paths |= changed_paths2
+
+    def close(self):
+        pass
+
+
+def get_watcher(roots):
+    try:
+        return InotifyWatcher(roots)
+    except InotifyWatcher.Unavailable as e:
+        print('inotify is unavailable ({}), falling back to polling'.format(e), file=sys.stderr)
+        return PollingWatcher(roots)
+
+
+def rebuild_on_change(watcher, build):
+    """
+    Call build(changed_paths) now and then whenever watched files change, until interrupted.
+    changed_paths is the set of paths changed since the last call to build which didn't raise,
+    or None if that is unknown (like before the first successful call).
+    """
+    pending_paths = None
+    try:
+        while True:
+            try:
+                build(pending_paths)
+            except Exception:
+                traceback.print_exc()
+            else:
+                pending_paths = set()
+            changed_paths = watcher.wait()
+            if changed_paths is None or pending_paths is None:
+                pending_paths = None
+            else:
+                pending_paths |= changed_paths
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
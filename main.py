@@ -4,43 +4,123 @@ import os
 from os.path import join as pjoin
 import argparse
 import time
+from functools import partial
 
-from lib import parse, process, render, common
+from lib import parse, process, render, common, store, watch, profile
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DEFAULT_THEME_DIR = pjoin(BASE_DIR, 'theme')
 
 
-def main():
+def build(args, records, changed_paths=None, timings=None):
+    """
+    Run the pipeline once.
+    changed_paths is passed to BuildManifest; it is None if any input file may have changed.
+    If timings is a dict, the time in seconds taken by each stage is stored in it.
+    """
     start_time = time.time()
+    stage = [None, start_time]
+    config = common.get_config(args.input_dir)
+    manifest = common.BuildManifest(records, changed_paths)
+    outputs = common.OutputTracker(args.output_dir, records)
+
+    def elapsed_time_str():
+        return '[{:.4f}]'.format(time.time() - start_time)
+
+    def start_stage(name):
+        now = time.time()
+        if timings is not None and stage[0] is not None:
+            timings[stage[0]] = now - stage[1]
+        stage[:] = [name, now]
+        profile.start_stage(None if name == 'done' else name)
+        print(elapsed_time_str(), name)
+
+    start_stage('parsing')
+    changed_ucis, modified_ucis = parse.process_all(args.input_dir,
+        args.intermediate_dir, records, outputs, config, manifest, jobs=args.jobs,
+        cache_size=args.conversion_cache_size * 2**20)
+
+    context_outdated = process.is_context_outdated(manifest)
+    layouts = None
+    if changed_ucis or context_outdated:
+        start_stage('processing')
+        render_ucis, layouts = process.process_all(args.input_dir, args.intermediate_dir,
+            outputs, records, config, manifest, changed_ucis, jobs=args.jobs)
+        modified_ucis |= render_ucis
+
+    start_stage('rendering')
+    render.render_all(args.theme, args.input_dir, args.intermediate_dir,
+        outputs, records, config, manifest, modified_ucis, jobs=args.jobs,
+        compiled_dir=args.compiled_templates, index_changed=bool(changed_ucis),
+        layouts=layouts)
+
+    start_stage('saving')
+    manifest.save(records)
+    outputs.save(records, args.intermediate_dir)
+    records.commit()
+    start_stage('done')
+
+
+def watch_and_build(args, records):
+    # start watching before the first build, so that no change is missed
+    watcher = watch.get_watcher([args.input_dir, args.theme])
+    print('watching {} and {} for changes'.format(args.input_dir, args.theme))
+    watch.rebuild_on_change(watcher, partial(build, args, records))
+
+
+def get_arg_parser():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('input_dir')
     parser.add_argument('intermediate_dir')
     parser.add_argument('output_dir')
     parser.add_argument('--theme', default=DEFAULT_THEME_DIR)
+    parser.add_argument('--compiled-templates',
+        help="Directory with the theme's templates precompiled by 'python -m lib.render'")
     parser.add_argument('--debug', action='store_true', default=False)
-    args = parser.parse_args()
-
-    common.debug = args.debug
-    config = common.get_config(args.input_dir, args.intermediate_dir)
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='Number of worker processes to use')
+    parser.add_argument('--conversion-cache-size', type=int, default=256,
+        help='Size bound in MiB of the Markdown conversion cache (0 to disable)')
+    parser.add_argument('--store', choices=store.STORE_CLASSES.keys(), default='dir',
+        help='How to store intermediate records in intermediate_dir'
+            ' (memory does not persist them, so every build is a full build)')
+    parser.add_argument('--in-memory', action='store_true', default=False,
+        help='Pass intermediate records between stages in memory'
+            ' and only write them to the store at the end of the build')
+    parser.add_argument('--watch', action='store_true', default=False,
+        help='After building, keep running and rebuild whenever the input or theme changes'
+            ' (implies --in-memory)')
+    parser.add_argument('--profile', metavar='TRACE_PATH',
+        help='Profile the build, write a Chrome trace-event JSON file to TRACE_PATH'
+            ' and print a summary of stages and the slowest nodes'
+            ' (only the main process is profiled, so use --jobs 1 to see every node)')
+    parser.add_argument('--profile-memory', action='store_true', default=False,
+        help='With --profile, also measure the peak memory usage of each stage'
+            ' with tracemalloc (which slows the build down)')
+    parser.add_argument('--profile-top', type=int, default=10,
+        help='Number of slowest nodes to show in the profile summary')
+    return parser
 
-    def elapsed_time_str():
-        return '[{:.4f}]'.format(time.time() - start_time)
 
-    print(elapsed_time_str(), 'parsing')
-    some_json_changed, modified_ucis = parse.process_all(args.input_dir,
-        args.intermediate_dir, config)
-
-    if some_json_changed:
-        print(elapsed_time_str(), 'processing')
-        process.process_all(args.input_dir, args.intermediate_dir, args.output_dir, config)
-
-    print(elapsed_time_str(), 'rendering')
-    render.render_all(args.theme, args.input_dir, args.intermediate_dir,
-        args.output_dir, config, some_json_changed, modified_ucis)
+def main():
+    args = get_arg_parser().parse_args()
 
-    common.write_timestamp(args.intermediate_dir, config['THIS_RUN_TIME'])
-    print(elapsed_time_str(), 'done')
+    common.debug = args.debug
+    if args.profile is not None:
+        profile.start(trace_memory=args.profile_memory)
+    records = store.open_store(args.store, args.intermediate_dir,
+        args.in_memory or args.watch)
+    try:
+        if args.watch:
+            watch_and_build(args, records)
+        else:
+            build(args, records)
+    finally:
+        records.close()
+        profiler = profile.stop()
+        if profiler is not None:
+            profiler.write_trace(args.profile)
+            print(profiler.get_summary(args.profile_top))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,273 @@
+import contextlib
+import filecmp
+import io
+import os
+import re
+from os.path import join as pjoin
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import main as concepdag
+from lib import common, search, store
+from lib.common import get_node_relpath
+from bench.corpus import generate
+from bench.run import edit_node
+from tests.test_graph import get_redundant_edges
+
+
+def get_args(input_dir, work_dir, store_kind):
+    return concepdag.get_arg_parser().parse_args([input_dir, pjoin(work_dir, 'intermediate'),
+        pjoin(work_dir, 'output'), '--store', store_kind])
+
+
+def build(args, records):
+    with contextlib.redirect_stdout(io.StringIO()):
+        concepdag.build(args, records)
+
+
+def get_diff(dir1, dir2):
+    # relative paths of files which differ between dir1 and dir2 or are only in one of them
+    diffs = []
+    cmp = filecmp.dircmp(dir1, dir2)
+    stack = [('', cmp)]
+    while stack:
+        relpath, cmp = stack.pop()
+        diffs += [pjoin(relpath, fname) for fname in cmp.left_only + cmp.right_only]
+        diffs += [pjoin(relpath, fname) for fname in cmp.common_files
+            if not filecmp.cmp(pjoin(cmp.left, fname), pjoin(cmp.right, fname), shallow=False)]
+        stack += [(pjoin(relpath, name), cmp2) for name, cmp2 in cmp.subdirs.items()]
+    return diffs
+
+
+def get_files(dirpath):
+    # contents of the files in dirpath, keyed by their relative paths with '/' separators
+    files = {}
+    for root, dirnames, fnames in os.walk(dirpath):
+        for fname in fnames:
+            fpath = pjoin(root, fname)
+            with open(fpath, 'rb') as fp:
+                files[os.path.relpath(fpath, dirpath).replace(os.sep, '/')] = fp.read()
+    return files
+
+
+def rename_node(input_dir, uci, uci2):
+    # move a node and update its dependents
+    nodes_dir = pjoin(input_dir, 'nodes')
+    fpath2 = pjoin(nodes_dir, *(uci2[1:] + '.json').split('/'))
+    os.makedirs(os.path.dirname(fpath2), exist_ok=True)
+    os.rename(pjoin(nodes_dir, *(uci[1:] + '.json').split('/')), fpath2)
+    for uci3, fpath in common.get_uci_fpath_list(nodes_dir):
+        d = common.read_json_obj(fpath)
+        if uci in d['deps']:
+            d['deps'] = [uci2 if uci4 == uci else uci4 for uci4 in d['deps']]
+            common.write_json_obj(d, fpath)
+
+
+def update_config(input_dir, **kwargs):
+    fpath = pjoin(input_dir, 'config.json')
+    config = common.read_json_obj(fpath)
+    config.update(kwargs)
+    common.write_json_obj(config, fpath)
+
+
+def get_node_fpath(input_dir, uci):
+    return pjoin(input_dir, 'nodes', *(uci[1:] + '.json').split('/'))
+
+
+class IncrementalBuildTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = pjoin(self.temp_dir, 'input')
+        self.ucis = generate(self.input_dir, 60, fan_in=2, chain_depth=6, sccs=2, inline_size=50)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def check_incremental(self, store_kind, in_memory):
+        # like --watch, keep the same records for all builds
+        args = get_args(self.input_dir, pjoin(self.temp_dir, 'incremental'), store_kind)
+        records = store.open_store(store_kind, args.intermediate_dir, in_memory)
+        edits = [
+            lambda: edit_node(self.input_dir, self.ucis[30]),
+            lambda: rename_node(self.input_dir, self.ucis[20], '/s0/s0/renamed'),
+            lambda: rename_node(self.input_dir, self.ucis[5], '/a/first'),
+        ]
+        try:
+            build(args, records)
+            for i, edit in enumerate(edits):
+                edit()
+                build(args, records)
+                fresh_args = get_args(self.input_dir, pjoin(self.temp_dir, 'fresh{}'.format(i)),
+                    store_kind)
+                fresh_records = store.open_store(store_kind, fresh_args.intermediate_dir)
+                try:
+                    build(fresh_args, fresh_records)
+                finally:
+                    fresh_records.close()
+                self.assertEqual(get_diff(args.output_dir, fresh_args.output_dir), [],
+                    'after edit {}'.format(i))
+        finally:
+            records.close()
+
+    def test_deploy_manifest(self):
+        args = get_args(self.input_dir, pjoin(self.temp_dir, 'work'), 'dir')
+        records = store.open_store('dir', args.intermediate_dir)
+        manifest_fpath = pjoin(args.intermediate_dir, 'deploy_manifest.json')
+
+        def check(expected_paths):
+            # the manifest must list exactly the files which the build added, changed and deleted
+            old_files = get_files(args.output_dir)
+            build(args, records)
+            files = get_files(args.output_dir)
+            manifest = common.read_json_obj(manifest_fpath)
+            self.assertEqual(list(manifest['added']), sorted(files.keys() - old_files.keys()))
+            self.assertEqual(list(manifest['changed']), sorted(relpath for relpath in files
+                if relpath in old_files and files[relpath] != old_files[relpath]))
+            self.assertEqual(manifest['deleted'], sorted(old_files.keys() - files.keys()))
+            for key, relpaths in expected_paths.items():
+                self.assertTrue(set(relpaths) <= set(manifest[key]), key)
+            return manifest
+
+        try:
+            manifest = check({})
+            self.assertIn('index.html', manifest['added'])
+            manifest = check({})
+            self.assertEqual(manifest, {'added': {}, 'changed': {}, 'deleted': []})
+
+            edit_node(self.input_dir, self.ucis[30])
+            manifest = check({'changed': [get_node_relpath(self.ucis[30])]})
+            # the new word 'edited' may only add a search index shard
+            self.assertTrue(all(relpath.startswith(search.INDEX_DIR + '/shards/')
+                for relpath in manifest['added']))
+            self.assertEqual(manifest['deleted'], [])
+
+            os.remove(get_node_fpath(self.input_dir, self.ucis[40]))
+            manifest = check({'deleted': [get_node_relpath(self.ucis[40])]})
+            self.assertEqual(manifest['added'], {})
+        finally:
+            records.close()
+
+    def test_dir(self):
+        self.check_incremental('dir', False)
+
+    def test_dir_in_memory(self):
+        self.check_incremental('dir', True)
+
+    def test_sqlite_in_memory(self):
+        self.check_incremental('sqlite', True)
+
+
+FAKE_DOT = """#!/bin/sh
+# fake graphviz, called as: dot -Tsvg IN -o OUT
+{}
+echo "<svg>$(wc -c < "$2")</svg>" > "$4"
+"""
+
+
+class GraphLayoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = pjoin(self.temp_dir, 'input')
+        self.ucis = generate(self.input_dir, 20, fan_in=2, chain_depth=4, inline_size=50)
+        update_config(self.input_dir, DISABLE=[])
+        self.bin_dir = pjoin(self.temp_dir, 'bin')
+        os.makedirs(self.bin_dir)
+        patcher = mock.patch.dict(os.environ,
+            {'PATH': self.bin_dir + os.pathsep + os.environ.get('PATH', '')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.args = get_args(self.input_dir, pjoin(self.temp_dir, 'work'), 'dir')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def set_dot(self, fail):
+        fpath = pjoin(self.bin_dir, 'dot')
+        with open(fpath, 'w') as fp:
+            fp.write(FAKE_DOT.format('exit 1' if fail else ''))
+        os.chmod(fpath, 0o755)
+
+    def build(self):
+        records = store.open_store('dir', self.args.intermediate_dir)
+        try:
+            with contextlib.redirect_stderr(io.StringIO()):
+                build(self.args, records)
+        finally:
+            records.close()
+        return common.read_json_obj(pjoin(self.args.intermediate_dir, 'deploy_manifest.json'))
+
+    def remove_dep(self, uci):
+        fpath = get_node_fpath(self.input_dir, uci)
+        d = common.read_json_obj(fpath)
+        d['deps'] = d['deps'][1:]
+        common.write_json_obj(d, fpath)
+
+    def has_graph(self):
+        return (os.path.exists(pjoin(self.args.output_dir, 'graph.svg')),
+            os.path.exists(pjoin(self.args.intermediate_dir, 'graph.svg')))
+
+    def test_failed_layout(self):
+        self.set_dot(fail=False)
+        self.build()
+        self.assertEqual(self.has_graph(), (True, True))
+
+        # change the graph, so that the old layout is stale
+        self.set_dot(fail=True)
+        self.remove_dep(self.ucis[-1])
+        deploy_manifest = self.build()
+        self.assertEqual(self.has_graph(), (False, False))
+        self.assertIn('graph.svg', deploy_manifest['deleted'])
+
+        self.set_dot(fail=False)
+        self.remove_dep(self.ucis[-2])
+        self.build()
+        self.assertEqual(self.has_graph(), (True, True))
+
+    def test_transitive_reduction(self):
+        generate(self.input_dir, 40, fan_in=2, chain_depth=5, sccs=2, inline_size=50)
+        update_config(self.input_dir, DISABLE=[], DOT_TRANSITIVE_REDUCTION=True)
+        # make some nodes also depend on a dependency of one of their dependencies
+        deps = {}
+        for uci, fpath in common.get_uci_fpath_list(pjoin(self.input_dir, 'nodes')):
+            deps[uci] = common.read_json_obj(fpath)['deps']
+        for uci in sorted(deps)[::3]:
+            if deps[uci] and deps[deps[uci][0]]:
+                uci2 = deps[deps[uci][0]][0]
+                if uci2 not in deps[uci] and uci2 != uci:
+                    deps[uci].append(uci2)
+                    fpath = get_node_fpath(self.input_dir, uci)
+                    d = common.read_json_obj(fpath)
+                    d['deps'] = deps[uci]
+                    common.write_json_obj(d, fpath)
+        self.set_dot(fail=False)
+        self.build()
+
+        edges = {(uci2, uci) for uci, ucis in deps.items() for uci2 in ucis}
+        redundant, is_witness, scc = get_redundant_edges(deps.keys(), edges)
+        self.assertTrue(redundant)
+        redundant_deps = common.read_json_obj(pjoin(self.args.intermediate_dir,
+            'redundant_deps.json'))
+        result = {(uci2, uci): via for uci, vias in redundant_deps.items()
+            for uci2, via in vias.items()}
+        self.assertEqual(set(result), redundant)
+        for (uci2, uci), via in result.items():
+            self.assertTrue(is_witness(uci2, uci, via))
+        with open(pjoin(self.args.intermediate_dir, 'graph.dot')) as fp:
+            dot_edges = set(re.findall(r'^"([^"]*)" -> "([^"]*)"', fp.read(), re.MULTILINE))
+        self.assertEqual(dot_edges, edges - redundant)
+
+    def test_disable_dot(self):
+        self.set_dot(fail=False)
+        self.build()
+        update_config(self.input_dir, DISABLE=['dot'])
+        deploy_manifest = self.build()
+        self.assertFalse(self.has_graph()[0])
+        self.assertIn('graph.svg', deploy_manifest['deleted'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+import random
+import unittest
+
+from lib.graph import Graph
+
+
+class OldGraph:
+    """scc and transitive_closure as they were before the closure was stored as bitsets."""
+
+    def __init__(self, n, edges):
+        self.adj = [[] for i in range(n)]
+        self.radj = [[] for i in range(n)]
+        for u, v in edges:
+            self.adj[u].append(v)
+            self.radj[v].append(u)
+
+    def scc(self):
+        n = len(self.adj)
+        fintime_order = []
+        visited = [False] * n
+
+        def visit1(u):
+            if not visited[u]:
+                visited[u] = True
+                for v in self.adj[u]:
+                    if not visited[v]:
+                        visit1(v)
+                fintime_order.append(u)
+
+        for r in range(n):
+            if not visited[r]:
+                visit1(r)
+
+        visited = [False] * n
+        cc = [-1] * n
+        self.depth = [0] * n
+
+        def visit2(u, cci):
+            if not visited[u]:
+                visited[u] = True
+                cc[u] = cci
+                for v in self.radj[u]:
+                    if cc[v] != cc[u] and cc[v] != -1:
+                        self.depth[u] = max(self.depth[u], self.depth[v] + 1)
+                    if not visited[v]:
+                        visit2(v, cci)
+
+        cci = 0
+        for r in reversed(fintime_order):
+            if not visited[r]:
+                visit2(r, cci)
+                cci += 1
+        self.topo_order = cc
+
+    def transitive_closure(self):
+        n = len(self.adj)
+        self.tradj = [[] for i in range(n)]
+
+        def visit(u, tarr):
+            if u not in visited:
+                visited.add(u)
+                tarr.append(u)
+                for v in self.radj[u]:
+                    if v not in visited:
+                        visit(v, tarr)
+
+        for r in range(n):
+            visited = set()
+            visit(r, self.tradj[r])
+            self.tradj[r].sort(key=(lambda x: self.topo_order[x]))
+
+
+def make_random_graph(rng, n, m, back_fraction):
+    # mostly forward edges, with a back_fraction of edges which may close cycles
+    edges = []
+    for i in range(m):
+        u, v = rng.randrange(n), rng.randrange(n)
+        if u > v and rng.random() >= back_fraction:
+            u, v = v, u
+        edges.append((u, v))
+    return edges
+
+
+class ClosureTest(unittest.TestCase):
+
+    def test_matches_old_implementation(self):
+        for seed in range(200):
+            rng = random.Random(seed)
+            n = rng.randint(1, 40)
+            edges = make_random_graph(rng, n, rng.randint(0, 3 * n), rng.choice([0, 0.05, 0.3]))
+            old_graph = OldGraph(n, edges)
+            old_graph.scc()
+            old_graph.transitive_closure()
+            graph = Graph()
+            for u in range(n):
+                graph.add_vertex(u)
+            for u, v in edges:
+                graph.add_edge(u, v)
+            if seed % 2:
+                graph.freeze()
+            graph.scc()
+            graph.transitive_closure()
+            for u in range(n):
+                self.assertEqual(graph.get_topo_order(u), old_graph.topo_order[u], (seed, u))
+                self.assertEqual(graph.get_depth(u), old_graph.depth[u], (seed, u))
+                self.assertEqual(graph.get_tradj(u), old_graph.tradj[u], (seed, u))
+
+
+def get_redundant_edges(labels, edges):
+    """
+    By brute force, the edges (u, v) between different SCCs such that u can reach
+    a predecessor w of v's SCC which is in neither u's nor v's SCC.
+    Returns the set of such edges and a function which checks whether w is such a vertex.
+    """
+    adj = {u: set() for u in labels}
+    for u, v in edges:
+        adj[u].add(v)
+    reach = {}
+    for r in labels:
+        reach[r] = {r}
+        stack = [r]
+        while stack:
+            for v in adj[stack.pop()]:
+                if v not in reach[r]:
+                    reach[r].add(v)
+                    stack.append(v)
+    scc = {u: frozenset(v for v in reach[u] if u in reach[v]) for u in labels}
+    preds = {}
+    for u, v in edges:
+        if scc[u] != scc[v]:
+            preds.setdefault(scc[v], set()).add(u)
+
+    def is_witness(u, v, w):
+        return w in preds[scc[v]] and scc[w] != scc[u] and w in reach[u]
+
+    redundant = {(u, v) for u, v in edges if scc[u] != scc[v]
+        and any(is_witness(u, v, w) for w in preds[scc[v]])}
+    return redundant, is_witness, scc
+
+
+def get_state(graph, labels):
+    # derived values of each vertex, with SCCs as sets of labels, which can be compared
+    # between graphs whose SCCs are numbered differently
+    sccs = {}
+    for label in labels:
+        sccs.setdefault(graph.get_topo_order(label), set()).add(label)
+    closure = graph.treach is not None
+    return {label: (graph.get_depth(label), frozenset(sccs[graph.get_topo_order(label)]),
+        closure and frozenset(graph.get_tadj(label)), closure and frozenset(graph.get_tradj(label)))
+        for label in labels}
+
+
+class IncrementalTest(unittest.TestCase):
+
+    def check(self, graph, labels, edges, msg):
+        fresh_graph = Graph()
+        for label in labels:
+            fresh_graph.add_vertex(label)
+        for u, v in edges:
+            fresh_graph.add_edge(u, v)
+        fresh_graph.scc()
+        if graph.treach is not None:
+            fresh_graph.transitive_closure()
+        state = get_state(graph, labels)
+        self.assertEqual(state, get_state(fresh_graph, labels), msg)
+        self.assertEqual(sorted(graph.get_labels()), sorted(labels), msg)
+        for u, v in edges:
+            self.assertLessEqual(graph.get_topo_order(u), graph.get_topo_order(v), msg)
+        return state
+
+    def test_matches_full_recompute(self):
+        for seed in range(300):
+            rng = random.Random(seed)
+            n = rng.randint(2, 14)
+            labels = set(range(n))
+            edges = set(make_random_graph(rng, n, rng.randint(0, 2 * n), 0.2))
+            graph = Graph()
+            for label in labels:
+                graph.add_vertex(label)
+            for u, v in edges:
+                graph.add_edge(u, v)
+            graph.freeze()
+            graph.scc()
+            # without the closure, only SCCs and depths are maintained
+            if seed % 2 == 0:
+                graph.transitive_closure()
+            graph.thaw()
+            state = self.check(graph, labels, edges, seed)
+            order = {label: graph.get_topo_order(label) for label in labels}
+            graph.pop_changed()
+            next_label = n
+            for step in range(20):
+                op = rng.random()
+                if op < 0.4 or not edges:
+                    # half of these are back edges, which can reorder or merge SCCs
+                    u, v = rng.sample(sorted(labels), 2)
+                    if (u, v) in edges:
+                        continue
+                    graph.add_edge(u, v)
+                    edges.add((u, v))
+                elif op < 0.8:
+                    u, v = rng.choice(sorted(edges))
+                    graph.remove_edge(u, v)
+                    edges.remove((u, v))
+                elif op < 0.9 and len(labels) > 2:
+                    label = rng.choice(sorted(labels))
+                    graph.remove_vertex(label)
+                    labels.remove(label)
+                    edges = {(u, v) for u, v in edges if label not in (u, v)}
+                else:
+                    graph.add_vertex(next_label)
+                    labels.add(next_label)
+                    next_label += 1
+                msg = (seed, step)
+                new_state = self.check(graph, labels, edges, msg)
+                new_order = {label: graph.get_topo_order(label) for label in labels}
+                changed = {label for label in labels if state.get(label) != new_state[label]
+                    or order.get(label) != new_order[label]}
+                self.assertEqual(set(graph.pop_changed()), changed, msg)
+                state, order = new_state, new_order
+
+
+class RedundantEdgesTest(unittest.TestCase):
+
+    def test_matches_brute_force(self):
+        n_cyclic = 0
+        for seed in range(200):
+            rng = random.Random(seed)
+            n = rng.randint(1, 30)
+            edges = make_random_graph(rng, n, rng.randint(0, 3 * n), rng.choice([0, 0.1, 0.3]))
+            graph = Graph()
+            for u in range(n):
+                graph.add_vertex(u)
+            for u, v in edges:
+                graph.add_edge(u, v)
+            if seed % 2:
+                graph.freeze()
+            result = graph.get_redundant_edges()
+            redundant, is_witness, scc = get_redundant_edges(range(n), edges)
+            n_cyclic += any(len(vertices) > 1 for vertices in scc.values())
+            self.assertEqual(set(result), redundant, seed)
+            ccs_via = {}
+            for (u, v), w in result.items():
+                self.assertTrue(is_witness(u, v, w), (seed, u, v, w))
+                # one witness for all edges between the same two SCCs
+                self.assertEqual(ccs_via.setdefault((scc[u], scc[v]), w), w, (seed, u, v))
+        self.assertGreater(n_cyclic, 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import random
+import unittest
+
+from lib.graph import Graph
+from lib.reach import ReachabilityIndex
+from tests.test_graph import make_random_graph
+
+
+def get_distances(adj, source):
+    dist = {source: 0}
+    frontier = [source]
+    while frontier:
+        next_frontier = []
+        for u in frontier:
+            for v in adj[u]:
+                if v not in dist:
+                    dist[v] = dist[u] + 1
+                    next_frontier.append(v)
+        frontier = next_frontier
+    return dist
+
+
+class ReachabilityIndexTest(unittest.TestCase):
+
+    def test_queries(self):
+        for seed in range(100):
+            rng = random.Random(seed)
+            n = rng.randint(1, 60)
+            edges = make_random_graph(rng, n, rng.randint(0, 3 * n), rng.choice([0, 0.05, 0.2]))
+            graph = Graph()
+            adj = [set() for u in range(n)]
+            for u in range(n):
+                graph.add_vertex(u)
+            for u, v in edges:
+                graph.add_edge(u, v)
+                adj[u].add(v)
+            graph.freeze()
+            index = ReachabilityIndex(graph, n_landmarks=rng.choice([0, 4]),
+                n_distance_landmarks=rng.choice([0, 2]))
+            for u in range(n):
+                dist = get_distances(adj, u)
+                for v in range(n):
+                    self.assertEqual(index.depends_on(v, u), v in dist, (seed, u, v))
+                    chain = index.get_chain(v, u)
+                    if v not in dist:
+                        self.assertIsNone(chain)
+                        continue
+                    self.assertEqual(len(chain), dist[v] + 1, (seed, u, v))
+                    self.assertEqual((chain[0], chain[-1]), (u, v))
+                    for w, x in zip(chain, chain[1:]):
+                        self.assertIn(x, adj[w])
+
+
+if __name__ == '__main__':
+    unittest.main()
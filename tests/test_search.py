@@ -0,0 +1,85 @@
+import os
+from os.path import join as pjoin
+import shutil
+import tempfile
+import unittest
+
+from lib import common, search, store
+from bench.corpus import generate
+from tests.test_build import get_args, build, update_config, get_node_fpath
+
+
+class SearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = pjoin(self.temp_dir, 'input')
+        self.ucis = generate(self.input_dir, 30, fan_in=2, chain_depth=4, inline_size=0)
+        update_config(self.input_dir, SEARCH_FIELDS=['title'], SEARCH_SHARD_PREFIX_LEN=3)
+        args = get_args(self.input_dir, self.temp_dir, 'dir')
+        records = store.open_store('dir', args.intermediate_dir, False)
+        try:
+            build(args, records)
+        finally:
+            records.close()
+        self.index_dir = pjoin(args.output_dir, *search.INDEX_DIR.split('/'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def read(self, relpath):
+        return common.read_json_obj(pjoin(self.index_dir, relpath))
+
+    def get_titles(self):
+        return {uci: common.read_json_obj(get_node_fpath(self.input_dir, uci))['metadata']['title']
+            for uci in self.ucis}
+
+    def query(self, meta, docs, shards, prefix):
+        # UCIs of documents with a token starting with prefix, like search.js
+        if len(prefix) >= meta['prefix_len']:
+            keys = [prefix[:meta['prefix_len']]]
+        else:
+            keys = [key for key in meta['shards'] if key.startswith(prefix)]
+        doc_ids = set()
+        for key in keys:
+            for token, token_doc_ids in shards.get(key, {}).items():
+                if token.startswith(prefix):
+                    doc_ids.update(token_doc_ids)
+        return {docs[doc_id][0] for doc_id in doc_ids}
+
+    def test_index(self):
+        meta = self.read('meta.json')
+        docs = self.read('docs.json')
+        self.assertEqual(meta['prefix_len'], 3)
+        self.assertEqual(meta['doc_fields'], ['uci', 'title'])
+        titles = self.get_titles()
+        self.assertEqual(sorted(docs), sorted([uci, title] for uci, title in titles.items()))
+
+        # one shard for each prefix of a token, named by the prefix's hex encoding
+        tokens = {token for title in titles.values() for token in search.tokenize(title)}
+        self.assertEqual(meta['shards'], sorted({token[:3] for token in tokens}))
+        self.assertEqual(sorted(os.listdir(pjoin(self.index_dir, 'shards'))),
+            sorted(key.encode('utf-8').hex() + '.json' for key in meta['shards']))
+        shards = {key: self.read('shards/{}.json'.format(key.encode('utf-8').hex()))
+            for key in meta['shards']}
+        for key, shard in shards.items():
+            self.assertTrue(shard)
+            self.assertTrue(all(token[:3] == key for token in shard))
+        self.assertEqual({token for shard in shards.values() for token in shard}, tokens)
+
+        # prefixes shorter than, as long as and longer than prefix_len
+        prefixes = {token[:k] for token in tokens for k in (1, 3, 4)}
+        for prefix in sorted(prefixes) + ['zzz']:
+            expected = {uci for uci, title in titles.items()
+                if any(token.startswith(prefix) for token in search.tokenize(title))}
+            self.assertEqual(self.query(meta, docs, shards, prefix), expected, prefix)
+
+    def test_doc_fields(self):
+        self.assertEqual(search.get_doc_fields(['title', 'tags', 'title']),
+            ['uci', 'title', 'tags'])
+        self.assertEqual(search.get_doc_fields([search.ALL_METADATA_FIELD]),
+            ['uci', 'title', 'description'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import http.client
+import os
+from os.path import join as pjoin
+import shutil
+from http.server import ThreadingHTTPServer
+import tempfile
+import threading
+import unittest
+
+from lib import common, serve
+from lib.common import get_node_relpath, get_node_fragment_relpath
+from bench.corpus import generate
+
+
+class SiteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.input_dir = pjoin(self.temp_dir, 'input')
+        self.ucis = generate(self.input_dir, 20, fan_in=2, chain_depth=4, inline_size=50)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def make_site(self, store_name):
+        site = serve.Site(self.input_dir, pjoin(self.temp_dir, 'intermediate'),
+            serve.DEFAULT_THEME_DIR, store_name=store_name)
+        self.addCleanup(site.close)
+        return site
+
+    def run_in_thread(self, f, *args):
+        # like the watcher and request handler threads of serve
+        result = []
+        thread = threading.Thread(target=lambda: result.append(f(*args)))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_sqlite_threads(self):
+        site = self.make_site('sqlite')
+        self.run_in_thread(site.update)
+        self.assertIsNotNone(self.run_in_thread(site.get_page, get_node_relpath(self.ucis[0])))
+
+    def test_deleted_node(self):
+        site = self.make_site('dir')
+        site.update()
+        uci = self.ucis[-1]
+        self.assertIsNotNone(site.get_page(get_node_relpath(uci)))
+        site.get_page(get_node_fragment_relpath(uci))
+        os.remove(pjoin(self.input_dir, 'nodes', *(uci[1:] + '.json').split('/')))
+        site.update()
+        self.assertIsNone(site.get_page(get_node_relpath(uci)))
+        self.assertIsNone(site.get_page(get_node_fragment_relpath(uci)))
+
+
+    def test_path_traversal(self):
+        site = self.make_site('dir')
+        site.update()
+        # a render context outside json2, which mustn't be served;
+        # json2 exists in intermediate_dir if it has the records of an earlier build
+        d = site.records.get('json2', self.ucis[0])
+        common.write_json_obj(d, pjoin(self.temp_dir, 'secret.json'))
+        os.makedirs(pjoin(self.temp_dir, 'intermediate', 'json2'))
+        relpath = 'nodes/../../secret.html'
+        self.assertIsNone(site.get_page(relpath))
+        self.assertIsNone(site.get_page(relpath[:-len('.html')] + '.deps.json'))
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0),
+            lambda *args, **kwargs: serve.RequestHandler(*args, site=site, **kwargs))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+            conn.request('GET', '/nodes/%2e%2e/%2e%2e/secret.html')
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(response.status, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
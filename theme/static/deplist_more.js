@@ -0,0 +1,94 @@
+"use strict";
+
+// Dependency lists longer than DEPLIST_CAP are truncated on node pages.
+// The items left out are in a JSON file next to the page,
+// which is fetched when a 'Show more' button is clicked.
+
+var deplist_fragments = {};
+
+function make_dep_item(dep, siteurl) {
+    var li = document.createElement('li');
+    if(dep['missing']) {
+        var span = document.createElement('span');
+        span.className = 'deptitleuci missing';
+        span.textContent = dep['uci'];
+        li.appendChild(span);
+    }
+    else {
+        var a = document.createElement('a');
+        a.setAttribute('href', siteurl + '/nodes' + dep['uci'] + '.html');
+        var title = document.createElement('span');
+        if(dep['title'] !== undefined) {
+            title.className = 'deptitle';
+            title.innerHTML = dep['title'];
+        }
+        else {
+            title.className = 'deptitleuci';
+            title.textContent = dep['uci'];
+        }
+        a.appendChild(title);
+        if(dep['status'] !== undefined) {
+            var status = document.createElement('span');
+            status.className = 'doc-status';
+            status.textContent = '(' + dep['status'] + ')';
+            a.appendChild(document.createTextNode(' '));
+            a.appendChild(status);
+        }
+        li.appendChild(a);
+    }
+    if(dep['reason'] !== undefined) {
+        var reason = document.createElement('span');
+        reason.className = 'reason';
+        reason.innerHTML = dep['reason'];
+        li.appendChild(document.createTextNode(' '));
+        li.appendChild(reason);
+    }
+    return li;
+}
+
+function show_more_deps(button, fragment) {
+    var deplist = button.previousElementSibling;
+    var deps = fragment[button.dataset.key];
+    var siteurl = button.dataset.siteurl;
+    for(var i=0; i<deps.length; ++i) {
+        deplist.appendChild(make_dep_item(deps[i], siteurl));
+    }
+    button.remove();
+    if(typeof MathJax !== 'undefined' && MathJax.typesetPromise) {
+        MathJax.typesetPromise([deplist]);
+    }
+}
+
+function fetch_more_deps(event) {
+    var button = event.target;
+    var url = button.dataset.url;
+    if(deplist_fragments[url] !== undefined) {
+        show_more_deps(button, deplist_fragments[url]);
+        return;
+    }
+    button.disabled = true;
+    var xhttp = new XMLHttpRequest();
+    xhttp.onreadystatechange = function() {
+        if(this.readyState == 4) {
+            if(this.status >= 200 && this.status <= 299) {
+                deplist_fragments[url] = JSON.parse(this.responseText);
+                show_more_deps(button, deplist_fragments[url]);
+            }
+            else {
+                console.error('status code for ' + url + ':', this.status);
+                button.disabled = false;
+            }
+        }
+    };
+    xhttp.open('GET', url, true);
+    xhttp.send();
+}
+
+function attach_more_buttons() {
+    var buttons = document.getElementsByClassName('deplist-more');
+    for(let button of buttons) {
+        button.addEventListener('click', fetch_more_deps);
+    }
+}
+
+attach_more_buttons();
@@ -60,38 +60,112 @@ var get_index_url = {}
 var create_index = {}
 var search_index = {}
 
-get_index_url['local'] = function() {return raw_url;}
-create_index['local'] = function (json) {return json;}
-
-search_index['local'] = function (index, query) {
-    var docs = index['corpus'];
-    var fields = index['fields'];
-    var docs2 = [];
-    var lower_query = query.toLowerCase();
-    for(var i=0; i<docs.length; ++i) {
-        for(var j=0; j<fields.length; ++j) {
-            var doc = docs[i];
-            var s = doc[fields[j]];
-            if(s !== undefined && s !== null) {
-                var found = false;
-                if(Array.isArray(s)) {
-                    for(var k=0; k<s.length; ++k) {
-                        if(s[k].toLowerCase().includes(lower_query)) {
-                            found = true;
-                            break;
-                        }
-                    }
-                }
-                else if(s.toLowerCase().includes(lower_query)) {
-                    found = true;
-                }
-                if(found) {
-                    docs2.push(doc);
+// 'local' uses the sharded inverted index in searchinfo/index, built by lib/search.py.
+// It finds documents which have, for every token in the query, a token starting with it.
+
+var index_url = siteurl + '/searchinfo/index';
+
+function tokenize(s) {
+    return s.toLowerCase().match(/[\p{L}\p{N}\p{M}_]+/gu) || [];
+}
+
+function to_hex(s) {
+    var bytes = new TextEncoder().encode(s);
+    var parts = [];
+    for(var i=0; i<bytes.length; ++i) {
+        parts.push(bytes[i].toString(16).padStart(2, '0'));
+    }
+    return parts.join('');
+}
+
+get_index_url['local'] = function() {return index_url + '/meta.json';}
+create_index['local'] = function (json) {
+    return {'meta': json, 'docs': null, 'shards': {}};
+}
+
+function get_shard_keys(meta, token) {
+    // keys of the shards which can have tokens starting with token
+    var chars = Array.from(token);
+    var prefix_len = meta['prefix_len'];
+    if(chars.length >= prefix_len) {
+        var key = chars.slice(0, prefix_len).join('');
+        return meta['shards'].includes(key) ? [key] : [];
+    }
+    return meta['shards'].filter(function(key) {return key.startsWith(token);});
+}
+
+function search_loaded_index(index, tokens) {
+    var doc_ids = null;
+    for(var i=0; i<tokens.length; ++i) {
+        var token = tokens[i];
+        var token_doc_ids = new Set();
+        var keys = get_shard_keys(index['meta'], token);
+        for(var j=0; j<keys.length; ++j) {
+            var shard = index['shards'][keys[j]];
+            for(var token2 in shard) {
+                if(token2.startsWith(token)) {
+                    shard[token2].forEach(function(doc_id) {token_doc_ids.add(doc_id);});
                 }
             }
         }
+        if(doc_ids === null) {
+            doc_ids = token_doc_ids;
+        }
+        else {
+            doc_ids = new Set([...doc_ids].filter(function(doc_id) {return token_doc_ids.has(doc_id);}));
+        }
     }
-    return docs2;
+    var fields = index['meta']['doc_fields'];
+    var results = [];
+    Array.from(doc_ids).sort(function(a, b) {return a - b;}).forEach(function(doc_id) {
+        var doc = {};
+        var values = index['docs'][doc_id];
+        for(var j=0; j<fields.length; ++j) {
+            if(values[j] !== null) {
+                doc[fields[j]] = values[j];
+            }
+        }
+        doc['url'] = siteurl + '/nodes' + doc['uci'] + '.html';
+        results.push(doc);
+    });
+    return results;
+}
+
+search_index['local'] = function (index, query, hook) {
+    var tokens = tokenize(query);
+    if(tokens.length === 0) {
+        hook([]);
+        return;
+    }
+    // fetch the document table and the shards which the query touches, if not already fetched
+    var requests = [];
+    if(index['docs'] === null) {
+        requests.push([index_url + '/docs.json', function(json) {index['docs'] = json;}]);
+    }
+    var keys = new Set();
+    for(var i=0; i<tokens.length; ++i) {
+        get_shard_keys(index['meta'], tokens[i]).forEach(function(key) {keys.add(key);});
+    }
+    keys.forEach(function(key) {
+        if(!(key in index['shards'])) {
+            requests.push([index_url + '/shards/' + to_hex(key) + '.json',
+                function(json) {index['shards'][key] = json;}]);
+        }
+    });
+    var pending = requests.length;
+    if(pending === 0) {
+        hook(search_loaded_index(index, tokens));
+        return;
+    }
+    requests.forEach(function(request) {
+        apply_to_json_response(request[0], function(json) {
+            request[1](json);
+            pending -= 1;
+            if(pending === 0) {
+                hook(search_loaded_index(index, tokens));
+            }
+        }, fail_hook);
+    });
 }
 
 get_index_url['elasticlunr'] = function () {
@@ -114,7 +188,7 @@ create_index['elasticlunr'] = function (json) {
     return index;
 }
 
-search_index['elasticlunr'] = function (index, query) {
+search_index['elasticlunr'] = function (index, query, hook) {
     var elasticlunr_results = index.search(query, {});
     console.log('elasticlunr_results:', elasticlunr_results);
     var results = []
@@ -122,7 +196,7 @@ search_index['elasticlunr'] = function (index, query) {
         results.push(elasticlunr_results[i]['doc']);
     }
     console.log('results:', results);
-    return results;
+    hook(results);
 }
 
 var search_library = 'local';
@@ -190,12 +264,11 @@ function ajax_hook(json) {
     var index = create_index[search_library](json);
     persistence['index'] = index;
     if(query !== null && query !== '') {
-        var results = search_index[search_library](index, query);
+        search_index[search_library](index, query, show_search_results);
     }
     else {
-        var results = [];
+        show_search_results([]);
     }
-    show_search_results(results);
 }
 
 if(query !== null && query !== '') {